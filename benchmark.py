@@ -0,0 +1,390 @@
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import laib
+
+BENCH_QUERIES = [
+    "list files",
+    "show disk usage",
+    "go to home folder",
+    "find python files modified today",
+    "count lines in all text files",
+    "show running processes",
+    "delete folder tmp",
+    "print current directory",
+]
+
+BENCH_COMMANDS = [
+    "ls -la",
+    "cd ~",
+    "du -sh ~",
+    "find . -name '*.py' -mtime -1",
+    "wc -l *.txt",
+    "ps aux | grep python | sort -k 3",
+    "rm -r tmp",
+    "echo $(date) && ls; cat file | sh",
+    "while true; do ls; done",
+    "FOO=1 xargs rm < list",
+]
+
+
+class FakeLMStudioHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self.send_json(200, {"data": [{"id": "fake-model"}]})
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        settings = self.server.settings
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        query = body["messages"][-1]["content"]
+
+        latency = max(0.0, random.gauss(settings.latency, settings.jitter))
+        time.sleep(latency)
+        if random.random() < settings.error_rate:
+            self.send_json(503, {"error": "model is busy"})
+            return
+
+        content = f"echo {query}\nThis echoes the query.\n"
+        if not body.get("stream"):
+            self.send_json(
+                200, {"choices": [{"message": {"role": "assistant", "content": content}}]}
+            )
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        try:
+            for token in content.split(" "):
+                chunk = {"choices": [{"delta": {"content": token + " "}}]}
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                self.wfile.flush()
+                time.sleep(settings.token_delay)
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client closes the stream after the first line
+            pass
+        self.close_connection = True
+
+    def send_json(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeLMStudioServer:
+    """Local stand-in for the LMStudio /v1/chat/completions endpoint."""
+
+    def __init__(self, latency=0.05, jitter=0.01, error_rate=0.0, token_delay=0.002):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), FakeLMStudioHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.settings = argparse.Namespace(
+            latency=latency, jitter=jitter, error_rate=error_rate, token_delay=token_delay
+        )
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def endpoint(self):
+        return f"http://127.0.0.1:{self.httpd.server_port}/v1/chat/completions"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def measure(name, operation, items, concurrency=1):
+    """Run operation over items and return latency/throughput/memory stats."""
+
+    def timed(item):
+        start = time.perf_counter()
+        ok = operation(item)
+        return time.perf_counter() - start, ok is not False
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(timed, items))
+    else:
+        results = [timed(item) for item in items]
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    samples = [duration * 1000 for duration, _ in results]
+    return {
+        "stage": name,
+        "count": len(results),
+        "errors": sum(1 for _, ok in results if not ok),
+        "p50_ms": round(percentile(samples, 0.50), 4),
+        "p95_ms": round(percentile(samples, 0.95), 4),
+        "p99_ms": round(percentile(samples, 0.99), 4),
+        "throughput_per_s": round(len(results) / elapsed, 1) if elapsed else 0.0,
+        "peak_alloc_kb": round(peak / 1024, 1),
+    }
+
+
+def bench_llm(args, endpoint, stream):
+    config = {
+        "lmstudio_endpoint": endpoint,
+        "stream": stream,
+        "max_retries": args.retries,
+        "retry_backoff": 0.01,
+    }
+    client = laib.LLMClient(config, laib.HTTPLog())
+    # Importing requests is startup cost, not request latency
+    client.connect()
+    queries = [BENCH_QUERIES[i % len(BENCH_QUERIES)] for i in range(args.requests)]
+    try:
+        return measure(
+            "ask_llm_stream" if stream else "ask_llm",
+            lambda query: not client.ask(query).startswith("Error:"),
+            queries,
+            args.concurrency,
+        )
+    finally:
+        client.close()
+
+
+def bench_failover(args, endpoint):
+    # The first endpoint always answers 503, the pool has to route around it
+    with FakeLMStudioServer(latency=args.latency, error_rate=1.0) as broken:
+        config = {
+            "endpoints": [broken.endpoint, endpoint],
+            "stream": False,
+            "max_retries": args.retries,
+            "retry_backoff": 0.01,
+        }
+        client = laib.LLMClient(config, laib.HTTPLog())
+        client.connect()
+        queries = [BENCH_QUERIES[i % len(BENCH_QUERIES)] for i in range(args.requests)]
+        try:
+            return measure(
+                "ask_llm_failover",
+                lambda query: not client.ask(query).startswith("Error:"),
+                queries,
+                args.concurrency,
+            )
+        finally:
+            client.close()
+
+
+def bench_cache(args, directory):
+    cache = laib.CommandCache(
+        os.path.join(directory, "bench_cache.db"),
+        max_entries=args.requests,
+        similarity_threshold=0.85,
+    )
+    namespace = ["lmstudio", "bench", "", laib.SYSTEM_PROMPT]
+    queries = [f"{BENCH_QUERIES[i % len(BENCH_QUERIES)]} {i}" for i in range(args.requests)]
+    try:
+        put = measure(
+            "cache_put", lambda query: cache.put(namespace, query, "ls"), queries
+        )
+        hit = measure(
+            "cache_get_hit", lambda query: cache.get(namespace, query), queries
+        )
+        miss = measure(
+            "cache_get_miss",
+            lambda query: cache.get(namespace, "unknown " + query) is None,
+            queries,
+        )
+        return [put, hit, miss]
+    finally:
+        cache.close()
+
+
+def bench_fast_path(args):
+    intents = laib.IntentMatcher()
+    queries = [BENCH_QUERIES[i % len(BENCH_QUERIES)] for i in range(args.requests)]
+    return measure("fast_path_match", intents.match, queries)
+
+
+def bench_history(args, directory):
+    path = os.path.join(directory, "bench_history.jsonl")
+    entries = 100000
+    now = time.time()
+    with open(path, "w") as file:
+        for i in range(entries):
+            query = f"{BENCH_QUERIES[i % len(BENCH_QUERIES)]} {i}"
+            file.write(json.dumps({"t": now - i * 60, "q": query}) + "\n")
+    history = laib.QueryHistory(path, max_entries=entries)
+    history.build_index()
+
+    prefixes = [query[: 1 + i % len(query)] for i, query in enumerate(BENCH_QUERIES)]
+    searches = ["files", "show disk", "folder tmp 7", "py mod", "count text", "zzz"]
+    return [
+        measure(
+            "history_suggest",
+            history.suggest,
+            [prefixes[i % len(prefixes)] for i in range(args.requests)],
+        ),
+        measure(
+            "history_search",
+            history.search,
+            [searches[i % len(searches)] for i in range(args.requests)],
+        ),
+    ]
+
+
+def bench_startup(args):
+    # A fresh interpreter each time, so nothing is already imported
+    directory = os.path.dirname(os.path.abspath(laib.__file__))
+    command = [sys.executable, "-c", "import laib"]
+    return measure(
+        "startup_import",
+        lambda _: subprocess.run(command, cwd=directory).returncode == 0,
+        range(max(1, args.requests // 20)),
+    )
+
+
+def bench_policy(args):
+    policy = laib.CommandPolicy(laib.ConfigStore())
+    commands = [BENCH_COMMANDS[i % len(BENCH_COMMANDS)] for i in range(args.requests)]
+    uncached = measure("policy_classify", policy.classify, commands)
+    memoized = measure("policy_check_memo", policy.check, commands)
+    return [uncached, memoized]
+
+
+def bench_logging(args):
+    log = laib.HTTPLog()
+    client = laib.LLMClient({}, log)
+    data = {
+        "messages": [
+            {"role": "system", "content": laib.SYSTEM_PROMPT},
+            {"role": "user", "content": "list files"},
+        ],
+        "stream": True,
+    }
+    result = {"choices": [{"message": {"role": "assistant", "content": "ls -la"}}]}
+
+    def log_request(_):
+        client.log("Request", data)
+        client.log("Response", result)
+
+    def render(_):
+        # What an open debug window does with the records of one request
+        _, records = log.since(log.sequence - 2)
+        "".join(f"{laib.HTTPLog.format(record)}\n" for record in records)
+
+    try:
+        return [
+            measure("debug_log", log_request, range(args.requests)),
+            measure("debug_log_render", render, range(args.requests)),
+        ]
+    finally:
+        client.close()
+
+
+def run(args):
+    results = []
+    with FakeLMStudioServer(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        token_delay=args.token_delay,
+    ) as server:
+        results.append(bench_llm(args, server.endpoint, stream=False))
+        results.append(bench_llm(args, server.endpoint, stream=True))
+        results.append(bench_failover(args, server.endpoint))
+
+    with tempfile.TemporaryDirectory() as directory:
+        results.extend(bench_cache(args, directory))
+        results.extend(bench_history(args, directory))
+    results.append(bench_startup(args))
+    results.append(bench_fast_path(args))
+    results.extend(bench_policy(args))
+    results.extend(bench_logging(args))
+    return results
+
+
+def print_table(results, file=sys.stdout):
+    columns = [
+        "stage",
+        "count",
+        "errors",
+        "p50_ms",
+        "p95_ms",
+        "p99_ms",
+        "throughput_per_s",
+        "peak_alloc_kb",
+    ]
+    widths = [max(len(c), *(len(str(r[c])) for r in results)) for c in columns]
+    print("  ".join(c.ljust(w) for c, w in zip(columns, widths)), file=file)
+    for result in results:
+        print(
+            "  ".join(str(result[c]).ljust(w) for c, w in zip(columns, widths)),
+            file=file,
+        )
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"max RSS: {max_rss / 1024:.1f} MB", file=file)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark LAIB# against a local fake LMStudio server"
+    )
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument(
+        "--latency", type=float, default=0.05, help="mean server latency in seconds"
+    )
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument(
+        "--token-delay",
+        type=float,
+        default=0.002,
+        help="delay between streamed tokens in seconds",
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="fraction of 503 responses"
+    )
+    parser.add_argument(
+        "--retries", type=int, default=2, help="client retries on 503 responses"
+    )
+    parser.add_argument("--json", metavar="FILE", help="also write results as JSON")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    laib.HEADLESS = True
+    results = run(args)
+    print_table(results)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
@@ -1,37 +1,378 @@
+import time
+
+# Taken before any other import, for --profile-startup
+PROCESS_START = time.perf_counter()
+
 import tkinter as tk
-from tkinter import scrolledtext, messagebox, Toplevel, simpledialog
+from tkinter import scrolledtext, messagebox, Toplevel, simpledialog, ttk
 import threading
-from tkterm import Terminal
 import os
-import requests
 import re
 import json
 import queue
+import importlib
+import sqlite3
+import hashlib
+import math
+import shlex
+import sys
+import argparse
+import subprocess
+import shutil
+import signal
+import bisect
+from contextlib import contextmanager
+from collections import Counter, deque, namedtuple
+import heapq
+import itertools
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Results are polled at roughly 60 fps while a request is in flight
+LLM_POLL_INTERVAL_MS = 16
+# How often config.json and the command lists are checked for changes
+CONFIG_POLL_INTERVAL_MS = 2000
+SPINNER_FRAMES = ["⣾", "⣽", "⣻", "⢿", "⡿", "⣟", "⣯", "⣷"]
+QUERY_LABEL_TEXT = 'Generate a command to... (e.g. "change to folder home" - "delete folder \'hi\'")'
 
 CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.json")
+CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache.db")
+BLOCKED_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "blocked_commands.txt"
+)
+WHITELISTED_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "whitelisted_commands.txt"
+)
+TOOL_INDEX_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "tool_index.json"
+)
+HISTORY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "history.jsonl")
+
+
+# Set by batch mode, where errors go to stderr instead of dialogs
+HEADLESS = False
+
+
+class StartupProfile:
+    """Wall-clock phases of startup, reported by --profile-startup."""
+
+    def __init__(self, start):
+        self.start = start
+        self.last = start
+        self.phases = []
+
+    def mark(self, name):
+        """Record the time since the previous mark as phase name."""
+        now = time.perf_counter()
+        self.phases.append((name, self.last - self.start, now - self.last))
+        self.last = now
+
+    @contextmanager
+    def phase(self, name):
+        # For work that may happen inside a marked phase or in another thread
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            self.phases.append((name, start - self.start, now - start))
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def report(self, file=sys.stderr):
+        width = max([5, *(len(name) for name, _, _ in self.phases)])
+        print("phase".ljust(width) + "start_ms".rjust(10) + "ms".rjust(10), file=file)
+        for name, start, duration in sorted(self.phases, key=lambda phase: phase[1]):
+            print(
+                f"{name.ljust(width)}{start * 1000:10.1f}{duration * 1000:10.1f}",
+                file=file,
+            )
+
+
+STARTUP = StartupProfile(PROCESS_START)
+
+
+class LazyModule:
+    """Stands in for a module and imports it on first attribute access."""
+
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+        self.lock = threading.Lock()
+
+    def __getattr__(self, attribute):
+        if self.module is None:
+            with self.lock:
+                if self.module is None:
+                    with STARTUP.phase(f"import {self.name}"):
+                        self.module = importlib.import_module(self.name)
+        return getattr(self.module, attribute)
 
 
-def load_config():
-    if os.path.exists(CONFIG_FILE):
+# Importing requests takes longer than building the whole window and is not
+# needed before the first query. Both show up in the startup profile
+requests = LazyModule("requests")
+tkterm = LazyModule("tkterm")
+
+
+def show_error(title, message):
+    if HEADLESS:
+        print(f"{title}: {message}", file=sys.stderr)
+    else:
+        messagebox.showerror(title, message)
+
+
+class LatencyHistogram:
+    # Upper bounds in seconds, from policy checks up to slow LLM requests
+    BUCKETS = (
+        0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+        0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+    )
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, fraction):
+        # Linear interpolation inside the bucket holding the rank
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.BUCKETS[index - 1] if index else 0.0
+                upper = self.BUCKETS[index] if index < len(self.BUCKETS) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / count, self.max)
+            seen += count
+        return 0.0
+
+
+class Metrics:
+    """Per-stage latency histograms and event counters for the whole process.
+
+    Recording is a lock and a few additions, so spans stay on all the time.
+    """
+
+    BUCKET_LABELS = [str(bound) for bound in LatencyHistogram.BUCKETS] + ["+Inf"]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.counters = Counter()
+            self.started = time.time()
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = LatencyHistogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
         try:
-            with open(CONFIG_FILE, "r") as file:
-                return json.load(file)
-        except json.JSONDecodeError:
-            messagebox.showerror("Errore", "Errore loading config.")
-    return {}
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def snapshot(self):
+        with self.lock:
+            stages = {
+                stage: {
+                    "count": h.count,
+                    "mean_ms": round(h.sum / h.count * 1000, 3),
+                    "p50_ms": round(h.quantile(0.50) * 1000, 3),
+                    "p95_ms": round(h.quantile(0.95) * 1000, 3),
+                    "p99_ms": round(h.quantile(0.99) * 1000, 3),
+                    "max_ms": round(h.max * 1000, 3),
+                    "total_ms": round(h.sum * 1000, 3),
+                }
+                for stage, h in sorted(self.histograms.items())
+            }
+            return {
+                "since": self.started,
+                "stages": stages,
+                "counters": dict(sorted(self.counters.items())),
+            }
+
+    def prometheus(self):
+        lines = [
+            "# HELP laib_stage_seconds Time spent in each stage of a query.",
+            "# TYPE laib_stage_seconds histogram",
+        ]
+        with self.lock:
+            for stage, h in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(self.BUCKET_LABELS, h.counts):
+                    cumulative += count
+                    lines.append(
+                        f'laib_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}'
+                    )
+                lines.append(f'laib_stage_seconds_sum{{stage="{stage}"}} {h.sum:.6f}')
+                lines.append(f'laib_stage_seconds_count{{stage="{stage}"}} {h.count}')
+            lines += [
+                "# HELP laib_events_total Cache hits, verdicts, errors and timeouts.",
+                "# TYPE laib_events_total counter",
+            ]
+            for name, value in sorted(self.counters.items()):
+                lines.append(f'laib_events_total{{event="{name}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def export(self, path):
+        """Write a Prometheus textfile (.prom) or a JSON stats file."""
+        if path.endswith(".prom"):
+            content = self.prometheus()
+        else:
+            content = json.dumps(self.snapshot(), indent=2)
+        # Written aside and renamed so collectors never read half a file
+        temporary = f"{path}.tmp"
+        with open(temporary, "w") as file:
+            file.write(content)
+        os.replace(temporary, path)
 
 
-def save_config(config):
-    try:
-        with open(CONFIG_FILE, "w") as file:
-            json.dump(config, file, indent=4)
-    except Exception as e:
-        messagebox.showerror("Error", f"Errore saving configuration: {e}")
+METRICS = Metrics()
+
 
+class ConfigStore:
+    """config.json and the command lists, parsed once and kept in memory.
 
-def configure_endpoint():
-    current_config = load_config()
-    current_endpoint = current_config.get("lmstudio_endpoint", "")
+    poll() compares the files' mtimes and reloads only what changed, so
+    edits made by hand are picked up without reading anything per query.
+    Writes replace the file atomically. Subscribers are called with the name
+    of what changed: "config", "blocked" or "whitelisted".
+    """
+
+    def __init__(
+        self,
+        config_file=CONFIG_FILE,
+        blocked_file=BLOCKED_FILE,
+        whitelisted_file=WHITELISTED_FILE,
+    ):
+        self.files = {
+            "config": config_file,
+            "blocked": blocked_file,
+            "whitelisted": whitelisted_file,
+        }
+        self.values = {}
+        self.mtimes = {}
+        self.subscribers = []
+        self.lock = threading.Lock()
+        for name in self.files:
+            self.load(name)
+
+    def mtime(self, name):
+        try:
+            return os.stat(self.files[name]).st_mtime_ns
+        except OSError:
+            return None
+
+    def load(self, name):
+        path = self.files[name]
+        mtime = self.mtime(name)
+        if name == "config":
+            value = {}
+            with METRICS.span("config_load"):
+                try:
+                    with open(path, "r") as file:
+                        value = json.load(file)
+                except FileNotFoundError:
+                    pass
+                except (OSError, json.JSONDecodeError) as e:
+                    show_error("Error", f"Error loading config: {e}")
+                    # Keep what was loaded last rather than fall back to defaults
+                    value = self.values.get(name, {})
+        else:
+            value = []
+            with METRICS.span("command_lists_load"):
+                try:
+                    with open(path, "r") as file:
+                        value = [line.strip() for line in file if line.strip()]
+                except FileNotFoundError:
+                    show_error(
+                        "File Missing", f"File {os.path.basename(path)} is missing."
+                    )
+                except OSError as e:
+                    show_error(
+                        "Error", f"Could not read {os.path.basename(path)}: {e}"
+                    )
+        with self.lock:
+            self.values[name] = value
+            self.mtimes[name] = mtime
+
+    def poll(self):
+        """Reload the files changed on disk and notify subscribers."""
+        changed = [name for name in self.files if self.mtime(name) != self.mtimes[name]]
+        for name in changed:
+            self.load(name)
+            self.notify(name)
+        return changed
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def notify(self, name):
+        for callback in self.subscribers:
+            callback(name)
+
+    def config(self):
+        with self.lock:
+            return dict(self.values["config"])
+
+    def commands(self, list_type):
+        with self.lock:
+            return list(self.values[list_type])
+
+    def write(self, name, text, value):
+        path = self.files[name]
+        temporary = f"{path}.tmp"
+        try:
+            with open(temporary, "w") as file:
+                file.write(text)
+            os.replace(temporary, path)
+        except OSError as e:
+            show_error("Error", f"Could not save {os.path.basename(path)}: {e}")
+            return False
+        with self.lock:
+            self.values[name] = value
+            self.mtimes[name] = self.mtime(name)
+        self.notify(name)
+        return True
+
+    def update_config(self, **changes):
+        config = self.config()
+        config.update(changes)
+        return self.write("config", json.dumps(config, indent=4) + "\n", config)
+
+    def save_commands(self, list_type, commands):
+        commands = [command.strip() for command in commands if command.strip()]
+        return self.write(list_type, "".join(f"{c}\n" for c in commands), commands)
+
+    def add_command(self, list_type, command):
+        commands = self.commands(list_type)
+        if command in commands:
+            return True
+        return self.save_commands(list_type, commands + [command])
+
+
+def configure_endpoint(store):
+    current_endpoint = store.config().get("lmstudio_endpoint", "")
 
     new_endpoint = simpledialog.askstring(
         "LMStudio Endpoint",
@@ -39,18 +380,51 @@ def configure_endpoint():
         initialvalue=current_endpoint,
     )
 
-    if new_endpoint:
-        current_config["lmstudio_endpoint"] = new_endpoint
-        save_config(current_config)
+    if new_endpoint and store.update_config(lmstudio_endpoint=new_endpoint):
         messagebox.showinfo("Success", "Endpoint edited!")
 
 
+class HTTPLog:
+    """Fixed-size ring buffer of raw request/response records.
+
+    Records are only formatted when a debug window displays them.
+    """
+
+    def __init__(self, max_records=500):
+        self.records = deque(maxlen=max_records)
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    def put(self, kind, payload):
+        with self.lock:
+            self.sequence += 1
+            self.records.append((self.sequence, time.time(), kind, payload))
+
+    def since(self, sequence):
+        # Records dropped from the ring before being read are skipped
+        with self.lock:
+            if sequence >= self.sequence:
+                return sequence, []
+            return self.sequence, [r for r in self.records if r[0] > sequence]
+
+    @staticmethod
+    def format(record):
+        _, timestamp, kind, payload = record
+        if not isinstance(payload, str):
+            payload = json.dumps(payload, indent=2)
+        return f"[{time.strftime('%H:%M:%S', time.localtime(timestamp))}] {kind}: {payload}"
+
+
 class HTTPDebugWindow(Toplevel):
-    def __init__(self, parent, http_queue):
+    MAX_LINES = 5000
+    ACTIVE_INTERVAL_MS = 100
+    IDLE_INTERVAL_MS = 1000
+
+    def __init__(self, parent, http_log, store):
         super().__init__(parent)
-        current_config = load_config()
-        endpoint = current_config.get("lmstudio_endpoint")
-        self.title(f"LMStudio Endpoint: {endpoint}")
+        self.store = store
+        self.update_title("config")
+        store.subscribe(self.update_title)
         self.geometry("700x400")
         self.configure(bg="#2E2E2E")
 
@@ -60,87 +434,2550 @@ class HTTPDebugWindow(Toplevel):
         self.text_area.pack(expand=True, fill="both", padx=10, pady=10)
         self.text_area.configure(state="disabled")
 
-        self.http_queue = http_queue
+        self.http_log = http_log
+        self.sequence = 0
+        self.interval = self.ACTIVE_INTERVAL_MS
         self.update_log()
 
+    def update_title(self, name):
+        if name == "config":
+            endpoint = self.store.config().get("lmstudio_endpoint")
+            self.title(f"LMStudio Endpoint: {endpoint}")
+
     def update_log(self):
-        while not self.http_queue.empty():
-            log_entry = self.http_queue.get()
+        # Nothing is formatted while the window is minimized or hidden
+        if self.winfo_viewable() and self.sequence != self.http_log.sequence:
+            self.sequence, records = self.http_log.since(self.sequence)
+            text = "".join(f"{HTTPLog.format(record)}\n" for record in records)
+
             self.text_area.configure(state="normal")
-            self.text_area.insert(tk.END, f"{log_entry}\n")
+            self.text_area.insert(tk.END, text)
+            lines = int(self.text_area.index("end-1c").split(".")[0])
+            if lines > self.MAX_LINES:
+                self.text_area.delete("1.0", f"{lines - self.MAX_LINES + 1}.0")
             self.text_area.configure(state="disabled")
-        self.after(100, self.update_log)
+            self.text_area.see(tk.END)
+            self.interval = self.ACTIVE_INTERVAL_MS
+        else:
+            self.interval = min(self.interval * 2, self.IDLE_INTERVAL_MS)
+        self.after(self.interval, self.update_log)
 
 
-def ask_LLM(query, http_queue):
+class MetricsWindow(Toplevel):
+    REFRESH_INTERVAL_MS = 1000
+    COLUMNS = ("count", "mean_ms", "p50_ms", "p95_ms", "p99_ms", "max_ms")
 
-    current_config = load_config()
-    endpoint = current_config.get("lmstudio_endpoint")
+    def __init__(self, parent, metrics, export_path=None):
+        super().__init__(parent)
+        self.title("Metrics")
+        self.geometry("700x400")
+        self.configure(bg="#2E2E2E")
+        self.metrics = metrics
+        self.export_path = export_path
 
-    if not endpoint:
-        return "Error: LMStudio endpoint not configured."
+        self.text_area = scrolledtext.ScrolledText(
+            self, wrap=tk.NONE, bg="#3C3C3C", fg="white", font=("Courier", 10)
+        )
+        self.text_area.pack(expand=True, fill="both", padx=10, pady=(10, 0))
 
-    system_prompt = (
-        "Context is a real bash linux shell.\n"
-        "Home folder is ~\n"
-        "list files with ls\n"
-        "If asked command, raw single simplest linux command possible must be generated, will be executed in a real shell, "
-        "written plaintext, no 'if/then/else/ constructions, only simplest commands, no escape chars, no quotes, no preambles, never to be used: '> /dev/null' or '/dev/null 2>&1', no loops.\n"
-    )
+        button_frame = tk.Frame(self, bg="#2E2E2E")
+        button_frame.pack(fill="x", padx=10, pady=10)
+        tk.Button(
+            button_frame, text="Export", command=self.export, bg="#252526", fg="white"
+        ).pack(side="left")
+        tk.Button(
+            button_frame, text="Reset", command=self.reset, bg="#252526", fg="white"
+        ).pack(side="left", padx=5)
+        self.refresh()
+
+    def render(self):
+        snapshot = self.metrics.snapshot()
+        width = max([5, *(len(stage) for stage in snapshot["stages"])])
+        lines = [
+            "stage".ljust(width) + "".join(c.rjust(11) for c in self.COLUMNS)
+        ]
+        for stage, values in snapshot["stages"].items():
+            lines.append(
+                stage.ljust(width)
+                + "".join(str(values[c]).rjust(11) for c in self.COLUMNS)
+            )
+        lines.append("")
+        for name, value in snapshot["counters"].items():
+            lines.append(f"{name}: {value}")
+        return "\n".join(lines)
 
-    request_messages = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": f"{query}"},
-    ]
+    def refresh(self):
+        if self.winfo_viewable():
+            self.text_area.configure(state="normal")
+            self.text_area.delete("1.0", tk.END)
+            self.text_area.insert(tk.END, self.render())
+            self.text_area.configure(state="disabled")
+        self.after(self.REFRESH_INTERVAL_MS, self.refresh)
 
-    data = {"messages": request_messages}
-    headers = {"Content-Type": "application/json"}
+    def export(self):
+        path = self.export_path or os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "metrics.json"
+        )
+        try:
+            self.metrics.export(path)
+        except OSError as e:
+            messagebox.showerror("Error", f"Could not write {path}: {e}", parent=self)
+            return
+        messagebox.showinfo("Metrics", f"Metrics written to {path}", parent=self)
+
+    def reset(self):
+        self.metrics.reset()
+        self.refresh()
+
+
+def read_stream(response, on_token=None):
+    content = ""
+    response.encoding = "utf-8"
+    for line in response.iter_lines(decode_unicode=True):
+        if not line or not line.startswith("data:"):
+            continue
+        chunk = line[len("data:") :].strip()
+        if chunk == "[DONE]":
+            break
+
+        delta = json.loads(chunk)["choices"][0].get("delta", {})
+        content += delta.get("content") or ""
+        if on_token:
+            on_token(content.lstrip())
+
+        # Only the first line is used, stop decoding as soon as it is complete
+        if "\n" in content.lstrip():
+            break
+    return content
+
+
+SYSTEM_PROMPT = (
+    "Context is a real bash linux shell.\n"
+    "Home folder is ~\n"
+    "list files with ls\n"
+    "If asked command, raw single simplest linux command possible must be generated, will be executed in a real shell, "
+    "written plaintext, no 'if/then/else/ constructions, only simplest commands, no escape chars, no quotes, no preambles, never to be used: '> /dev/null' or '/dev/null 2>&1', no loops.\n"
+)
+
+# Gateway errors are usually a server that is still loading the model
+RETRY_STATUS_CODES = (502, 503, 504)
+
+
+class LLMError(Exception):
+    pass
+
+
+def models_url(url):
+    # The cheapest request every OpenAI-compatible server answers
+    if "/chat/completions" in url:
+        return url.rsplit("/chat/completions", 1)[0] + "/models"
+    return url.rsplit("/", 1)[0] + "/models"
+
+
+class Endpoint:
+    """One server of an EndpointPool, with its latency and circuit state."""
+
+    # Weight of the newest sample in the moving average of the latency
+    SMOOTHING = 0.3
+
+    def __init__(self, url, weight=1):
+        self.url = url
+        self.probe_url = models_url(url)
+        self.weight = max(float(weight), 0.01)
+        self.latency = None
+        self.in_flight = 0
+        self.failures = 0
+        # When the circuit opened, None while it is closed
+        self.opened = None
+
+    def score(self):
+        # Endpoints that just failed go last, those without a measurement
+        # first so each gets one
+        latency = (self.latency or 0.0) * (1 + self.in_flight) / self.weight
+        return self.failures, latency, self.in_flight
+
+
+class EndpointPool:
+    """Routes requests to the fastest healthy server in a list.
+
+    Every endpoint has a circuit breaker: after `failures` errors in a row
+    (or one failed health probe) it is skipped while another endpoint is
+    healthy, and probed again after `cooldown` seconds. When no healthy
+    endpoint is left, a request tries one that is not already being tried,
+    so a server that comes back is used right away. Endpoints with errors
+    are tried last until a request or probe succeeds on them.
+    """
+
+    def __init__(self, endpoints, failures=3, cooldown=30):
+        self.endpoints = []
+        for entry in endpoints:
+            if isinstance(entry, str):
+                entry = {"url": entry}
+            if entry.get("url"):
+                self.endpoints.append(Endpoint(entry["url"], entry.get("weight", 1)))
+        self.failures = failures
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+
+    def describe(self):
+        return " ".join(endpoint.url for endpoint in self.endpoints)
+
+    def choose(self, exclude=()):
+        """Best endpoint not in exclude, or None if all are cut off.
+
+        The caller must release() the endpoint when its request is done.
+        """
+        with self.lock:
+            candidates = [e for e in self.endpoints if e not in exclude]
+            closed = [e for e in candidates if e.opened is None]
+            if closed:
+                endpoint = min(closed, key=Endpoint.score)
+            else:
+                # Half open: one trial request at a time, the one open longest
+                idle = [e for e in candidates if not e.in_flight]
+                if not idle:
+                    return None
+                endpoint = min(idle, key=lambda e: e.opened)
+            endpoint.in_flight += 1
+            return endpoint
+
+    def release(self, endpoint):
+        with self.lock:
+            endpoint.in_flight -= 1
+
+    def success(self, endpoint, latency=None):
+        """Record an answer. Returns True if it closed the circuit."""
+        with self.lock:
+            if latency is not None:
+                if endpoint.latency is None:
+                    endpoint.latency = latency
+                else:
+                    endpoint.latency += Endpoint.SMOOTHING * (latency - endpoint.latency)
+            endpoint.failures = 0
+            recovered = endpoint.opened is not None
+            endpoint.opened = None
+            return recovered
+
+    def failure(self, endpoint, probe=False):
+        """Record an error. Returns True if it opened the circuit."""
+        with self.lock:
+            endpoint.failures += 1
+            if endpoint.opened is not None:
+                # A failed half-open try waits for another cooldown
+                endpoint.opened = time.monotonic()
+                return False
+            # A request may fail for reasons of its own, a probe may not
+            if probe or endpoint.failures >= self.failures:
+                endpoint.opened = time.monotonic()
+                return True
+            return False
+
+    def unavailable(self):
+        return "all endpoints are failing and already being retried."
+
+    def probe(self, session, timeout):
+        """GET the models URL of every endpoint; yields (endpoint, up) changes."""
+        now = time.monotonic()
+        for endpoint in self.endpoints:
+            opened = endpoint.opened
+            if opened is not None and now - opened < self.cooldown:
+                continue
+            try:
+                with METRICS.span("health_probe"):
+                    response = session.get(endpoint.probe_url, timeout=timeout)
+                response.close()
+                # Servers without /models still answer
+                up = response.status_code < 500
+            except requests.exceptions.RequestException:
+                up = False
+            if up and self.success(endpoint):
+                yield endpoint, True
+            elif not up and self.failure(endpoint, probe=True):
+                yield endpoint, False
+
+
+class LLMBackend:
+    name = "base"
+    # Backends talking to servers route through an EndpointPool
+    pool = None
+
+    def __init__(self, config):
+        self.config = config
+
+    def describe(self):
+        return self.name
+
+    def chat(self, client, messages, on_token=None):
+        raise NotImplementedError
+
+    def chat_choices(self, client, messages, n):
+        raise NotImplementedError
+
+
+class OpenAICompatibleBackend(LLMBackend):
+    name = "openai"
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.endpoint = self.configured_endpoint(config)
+        self.model = config.get("model")
+        self.api_key = config.get("api_key")
+        self.stream = config.get("stream", True)
+        self.pool = EndpointPool(
+            config.get("endpoints") or ([self.endpoint] if self.endpoint else []),
+            config.get("breaker_failures", 3),
+            config.get("breaker_cooldown", 30),
+        )
 
-    try:
+    def configured_endpoint(self, config):
+        return config.get("endpoint") or config.get("lmstudio_endpoint")
+
+    def describe(self):
+        return self.pool.describe()
+
+    def build_request(self, messages):
+        data = {"messages": messages, "stream": self.stream}
+        if self.model:
+            data["model"] = self.model
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        return headers, data
+
+    def chat(self, client, messages, on_token=None):
+        if not self.pool.endpoints:
+            raise LLMError("endpoint not configured.")
+
+        headers, data = self.build_request(messages)
         # Registra la richiesta
-        http_queue.put(f"Request: {json.dumps(data, indent=2)}")
+        client.log("Request", data)
+
+        with client.post(self.pool, headers, data, self.stream) as response:
+            content_type = response.headers.get("Content-Type", "")
+            if self.stream and content_type.startswith("text/event-stream"):
+                with METRICS.span("llm_stream"):
+                    content = read_stream(response, on_token)
+                client.log("Response (stream)", content)
+                return content
 
-        # Esegui la richiesta con timeout
-        response = requests.post(endpoint, headers=headers, json=data, timeout=10)
-        response.raise_for_status()
-        result = response.json()
+            with METRICS.span("llm_parse"):
+                result = response.json()
 
         # Registra la risposta
-        http_queue.put(f"Response: {json.dumps(result, indent=2)}")
+        client.log("Response", result)
 
         return result["choices"][0]["message"]["content"]
-    except requests.exceptions.Timeout:
-        http_queue.put("Error: Request timed out.")
-        return "Error: Request timed out."
-    except Exception as e:
-        http_queue.put(f"Error: {e}")
-        return f"Error: {e}"
 
+    def chat_choices(self, client, messages, n):
+        headers, data = self.build_request(messages)
+        data.update(stream=False, n=n)
+        client.log("Request", data)
+
+        with client.post(self.pool, headers, data) as response:
+            with METRICS.span("llm_parse"):
+                result = response.json()
+        client.log("Response", result)
+
+        return [choice["message"]["content"] for choice in result["choices"]]
+
+
+class LMStudioBackend(OpenAICompatibleBackend):
+    name = "lmstudio"
+
+    def configured_endpoint(self, config):
+        return config.get("lmstudio_endpoint")
+
+    def chat(self, client, messages, on_token=None):
+        if not self.pool.endpoints:
+            raise LLMError("LMStudio endpoint not configured.")
+        return super().chat(client, messages, on_token)
+
+
+class FakeBackend(LLMBackend):
+    """In-process backend answering from "fake_responses" in the config."""
+
+    name = "fake"
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.responses = config.get("fake_responses", {})
+        self.latency = config.get("fake_latency", 0.0)
+
+    def chat(self, client, messages, on_token=None):
+        query = messages[-1]["content"]
+        client.log("Request (fake)", query)
+        time.sleep(self.latency)
+
+        content = self.responses.get(query, f"echo {query}")
+        if on_token:
+            for end in range(1, len(content.split()) + 1):
+                on_token(" ".join(content.split()[:end]))
+        client.log("Response (fake)", content)
+        return content
+
+    def chat_choices(self, client, messages, n):
+        # One request for all n choices, like "n" on a real server
+        query = messages[-1]["content"]
+        client.log("Request (fake)", {"query": query, "n": n})
+        time.sleep(self.latency)
+
+        contents = [self.responses.get(query, f"echo {query}")] * n
+        client.log("Response (fake)", contents)
+        return contents
+
+
+LLM_BACKENDS = {
+    backend.name: backend
+    for backend in (LMStudioBackend, OpenAICompatibleBackend, FakeBackend)
+}
+# Config keys read by the backends; changing any other key keeps the current
+# backend, with its circuit breakers and measured latencies
+BACKEND_CONFIG_KEYS = (
+    "backend",
+    "endpoint",
+    "endpoints",
+    "lmstudio_endpoint",
+    "model",
+    "api_key",
+    "stream",
+    "breaker_failures",
+    "breaker_cooldown",
+    "fake_responses",
+    "fake_latency",
+)
+
+
+def estimate_tokens(text):
+    # Roughly 4 characters per token for English text and shell commands
+    return (len(text) + 3) // 4
+
+
+ShellContext = namedtuple("ShellContext", ["text", "digest"])
+
+
+def build_shell_context(cwd, commands, output, max_tokens):
+    """Pack the current folder, recent commands and the last output tail.
+
+    commands are newest first. The folder always fits, commands may use half
+    of what is left and the output tail the rest.
+    """
+    if max_tokens <= 0:
+        return None
+    lines = [f"Current folder: {cwd}"]
+    budget = max_tokens - estimate_tokens(lines[0])
+
+    recent = []
+    command_budget = budget // 2
+    for command in commands:
+        cost = estimate_tokens(command + "\n")
+        if cost > command_budget:
+            break
+        recent.insert(0, command)
+        command_budget -= cost
+    if recent:
+        lines.append("Recent commands, oldest first:")
+        lines.extend(recent)
+        budget -= estimate_tokens("\n".join(lines[1:]) + "\n")
+
+    output = output.strip() if output else ""
+    header = "End of the last command output:"
+    room = (budget - estimate_tokens(header + "\n")) * 4
+    if output and room > 0:
+        tail = output[-room:]
+        if len(tail) < len(output) and "\n" in tail:
+            # Never start in the middle of a line
+            tail = tail.split("\n", 1)[1]
+        lines.append(header)
+        lines.append(tail)
+
+    text = "\n".join(lines)
+    return ShellContext(text, hashlib.sha256(text.encode()).hexdigest()[:16])
+
+
+# Follow-ups such as "now delete the biggest one" depend on what was run before
+REFERS_BACK_RE = re.compile(
+    r"\b(?:it|that|those|them|one|ones|above|previous|last|again|same|now"
+    r"|output|result|results|error|errors)\b",
+    re.IGNORECASE,
+)
+
+
+def cache_context(query, context):
+    """The shell context a cached answer to query depends on, if any.
+
+    Only follow-ups are cached per shell state. Other answers are shared
+    across folders, sessions, batch runs and the fast path.
+    """
+    if context is not None and REFERS_BACK_RE.search(query):
+        return context
+    return None
+
+
+class LLMClient:
+    def __init__(self, config, http_log, tool_index=None):
+        self.http_log = http_log
+        self.tool_index = tool_index
+        self.session = None
+        self.session_lock = threading.Lock()
+        self.closed = threading.Event()
+        self.backend_config = None
+        self.configure(config)
+        threading.Thread(target=self.watch_health, daemon=True).start()
+
+    def connect(self):
+        """Return the HTTP session, creating it on first use."""
+        with self.session_lock:
+            if self.session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=2, pool_maxsize=4
+                )
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self.session = session
+            return self.session
+
+    def configure(self, config):
+        self.connect_timeout = config.get("connect_timeout", 3)
+        self.read_timeout = config.get("read_timeout", 10)
+        self.max_retries = config.get("max_retries", 2)
+        self.retry_backoff = config.get("retry_backoff", 0.5)
+        self.use_n_parameter = config.get("use_n_parameter", False)
+        self.max_concurrency = max(1, config.get("llm_concurrency", 1))
+        self.tool_context_tokens = config.get("tool_context_tokens", 60)
+        self.health_interval = config.get("health_interval", 10)
+        self.health_timeout = config.get("health_timeout", 2)
+
+        backend_config = {key: config.get(key) for key in BACKEND_CONFIG_KEYS}
+        if backend_config == self.backend_config:
+            return
+        self.backend_config = backend_config
+        backend_name = config.get("backend", "lmstudio")
+        backend_class = LLM_BACKENDS.get(backend_name)
+        if backend_class is None:
+            self.log("Error", f"unknown backend '{backend_name}', using lmstudio.")
+            backend_class = LMStudioBackend
+        self.backend = backend_class(config)
+
+    def log(self, kind, payload):
+        self.http_log.put(kind, payload)
+
+    @contextmanager
+    def post(self, pool, headers, data, stream=False):
+        """POST to the best endpoint of pool, failing over to the others.
+
+        Once every endpoint failed, the whole round is retried with backoff.
+        The endpoint stays in flight until the response is closed on exit.
+        """
+        attempt = 0
+        tried = set()
+        while True:
+            endpoint = pool.choose(tried)
+            if endpoint is None:
+                if not tried:
+                    raise LLMError(pool.unavailable())
+                if attempt >= self.max_retries:
+                    raise error
+                delay = self.retry_backoff * 2**attempt
+                attempt += 1
+                METRICS.incr("llm_retries")
+                self.log("Retry", f"{attempt}/{self.max_retries} in {delay:.1f}s: {error}")
+                time.sleep(delay)
+                tried = set()
+                continue
+            if tried:
+                METRICS.incr("llm_failovers")
+                self.log("Failover", endpoint.url)
+            tried.add(endpoint)
+
+            start = time.perf_counter()
+            try:
+                # Until the response headers arrive; the body is read by the caller
+                with METRICS.span("llm_http"):
+                    response = self.connect().post(
+                        endpoint.url,
+                        headers=headers,
+                        json=data,
+                        timeout=(self.connect_timeout, self.read_timeout),
+                        stream=stream,
+                    )
+                if response.status_code in RETRY_STATUS_CODES:
+                    response.close()
+                    response.raise_for_status()
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+                requests.exceptions.HTTPError,
+            ) as e:
+                pool.release(endpoint)
+                error = e
+                # Connect timeouts are connection errors too
+                if isinstance(e, requests.exceptions.ReadTimeout):
+                    # A slow generation is failed over from, but neither
+                    # retried nor counted against the server
+                    attempt = self.max_retries
+                else:
+                    self.record_failure(pool, endpoint)
+                continue
+            except BaseException:
+                pool.release(endpoint)
+                raise
+
+            if response.status_code >= 400:
+                # Answered, but not retried: a 4xx is the request's fault
+                response.close()
+                pool.release(endpoint)
+                if response.status_code >= 500:
+                    self.record_failure(pool, endpoint)
+                response.raise_for_status()
+
+            if pool.success(endpoint, time.perf_counter() - start):
+                self.log("Health", f"{endpoint.url} is back.")
+            try:
+                yield response
+            finally:
+                response.close()
+                pool.release(endpoint)
+            return
+
+    def record_failure(self, pool, endpoint):
+        if pool.failure(endpoint):
+            METRICS.incr("llm_circuit_opened")
+            self.log(
+                "Error",
+                f"{endpoint.url} failed {endpoint.failures} times in a row, "
+                f"skipping it for {pool.cooldown}s.",
+            )
+
+    def watch_health(self):
+        while not self.closed.wait(self.health_interval or 60):
+            pool = self.backend.pool
+            if not self.health_interval or pool is None:
+                continue
+            for endpoint, up in pool.probe(self.connect(), self.health_timeout):
+                if up:
+                    self.log("Health", f"{endpoint.url} is back.")
+                else:
+                    METRICS.incr("llm_circuit_opened")
+                    self.log("Health", f"{endpoint.url} is down, skipping it.")
+
+    def build_messages(self, query, context=None):
+        system_prompt = SYSTEM_PROMPT
+        if self.tool_index is not None and self.tool_context_tokens > 0:
+            tools = self.tool_index.context(query, self.tool_context_tokens)
+            if tools:
+                system_prompt += f"Installed tools:\n{tools}\n"
+        if context is not None:
+            system_prompt += f"Shell state:\n{context.text}\n"
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": f"{query}"},
+        ]
+
+    def ask(self, query, on_token=None, context=None):
+        with METRICS.span("prompt_build"):
+            request_messages = self.build_messages(query, context)
+
+        METRICS.incr("llm_requests")
+        try:
+            with METRICS.span("llm_request"):
+                content = self.backend.chat(self, request_messages, on_token)
+            if not content.strip():
+                # Never cached or run as an empty command
+                raise LLMError("the model returned an empty response.")
+            return content
+        except requests.exceptions.Timeout:
+            METRICS.incr("llm_timeouts")
+            self.log("Error", "Request timed out.")
+            return "Error: Request timed out."
+        except Exception as e:
+            METRICS.incr("llm_errors")
+            self.log("Error", str(e))
+            return f"Error: {e}"
+
+    def ask_candidates(self, query, n, context=None):
+        """Return n responses, from one request with "n" or n separate ones."""
+        if self.use_n_parameter:
+            try:
+                return self.backend.chat_choices(
+                    self, self.build_messages(query, context), n
+                )
+            except Exception as e:
+                self.log("Error", str(e))
+                return [f"Error: {e}"]
+
+        # Separate requests stay within the llm_concurrency cap
+        parallel = min(n, self.max_concurrency)
+        if parallel == 1:
+            return [self.ask(query, context=context) for _ in range(n)]
+        with ThreadPoolExecutor(max_workers=parallel) as pool:
+            return list(
+                pool.map(lambda _: self.ask(query, context=context), range(n))
+            )
+
+    def cache_namespace(self, context=None):
+        # Cached commands are only valid for the same server, model, prompt
+        # and shell state
+        namespace = [
+            self.backend.name,
+            self.backend.describe(),
+            self.backend.config.get("model", ""),
+            SYSTEM_PROMPT,
+        ]
+        if context is not None:
+            namespace.append(context.digest)
+        return namespace
+
+    def close(self):
+        self.closed.set()
+        if self.session is not None:
+            self.session.close()
+
+
+# Lower runs first: a query the user is waiting for beats speculative work
+PRIORITY_USER = 0
+PRIORITY_PREFETCH = 1
+PRIORITY_BATCH = 2
+
+
+class LLMTask:
+    def __init__(self, key, query, priority, context=None):
+        self.key = key
+        self.query = query
+        self.priority = priority
+        self.context = context
+        # One (future, on_token) pair per caller sharing this request
+        self.subscribers = []
+        self.partial = ""
+        self.started = False
+        self.cancelled = False
+        self.created = time.perf_counter()
+
+
+class LLMScheduler:
+    """Priority queue in front of the LLM client.
+
+    Identical queries that are queued or running share one request, and at
+    most max_concurrency requests reach the server at the same time. Every
+    caller gets its own future; a queued request is only dropped once all of
+    its callers have cancelled theirs.
+    """
+
+    def __init__(self, client, max_concurrency=1):
+        self.client = client
+        self.queue = []
+        self.tasks = {}
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.workers = [
+            threading.Thread(target=self.work, daemon=True)
+            for _ in range(max(1, max_concurrency))
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, query, priority=PRIORITY_USER, on_token=None, context=None):
+        # The same query asked in a different shell state is a different request
+        key = (normalize_query(query), context.digest if context else None)
+        future = Future()
+        with self.condition:
+            task = self.tasks.get(key)
+            if task is not None:
+                METRICS.incr("llm_coalesced")
+                if on_token and task.partial:
+                    on_token(task.partial)
+                if priority < task.priority and not task.started:
+                    task.priority = priority
+                    heapq.heappush(self.queue, (priority, next(self.counter), task))
+                if task.started:
+                    future.set_running_or_notify_cancel()
+            else:
+                task = LLMTask(key, query, priority, context)
+                self.tasks[key] = task
+                heapq.heappush(self.queue, (priority, next(self.counter), task))
+                self.condition.notify()
+            task.subscribers.append((future, on_token))
+        future.add_done_callback(lambda f: self.unsubscribe(task, f))
+        return future
+
+    def unsubscribe(self, task, future):
+        if not future.cancelled():
+            return
+        with self.condition:
+            task.subscribers = [
+                pair for pair in task.subscribers if pair[0] is not future
+            ]
+            if not task.subscribers and not task.started:
+                task.cancelled = True
+                if self.tasks.get(task.key) is task:
+                    del self.tasks[task.key]
+
+    def queue_depth(self):
+        with self.condition:
+            return sum(not task.started for task in self.tasks.values())
+
+    def work(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                priority, _, task = heapq.heappop(self.queue)
+                # Entries left behind by a priority bump or a cancel are skipped
+                if task.started or task.cancelled or priority != task.priority:
+                    continue
+                task.started = True
+                # From here on a caller can no longer cancel the shared request
+                running = [
+                    future.set_running_or_notify_cancel()
+                    for future, _ in task.subscribers
+                ]
+                if not any(running):
+                    task.cancelled = True
+                    del self.tasks[task.key]
+                    continue
+            METRICS.observe("scheduler_wait", time.perf_counter() - task.created)
+
+            result, error = None, None
+            try:
+                result = self.client.ask(
+                    task.query, lambda p: self.emit(task, p), task.context
+                )
+            except Exception as e:
+                error = e
+
+            with self.condition:
+                if self.tasks.get(task.key) is task:
+                    del self.tasks[task.key]
+                # Callers that joined while the request was running get it too
+                futures = [
+                    future for future, _ in task.subscribers if not future.cancelled()
+                ]
+            for future in futures:
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+
+    def emit(self, task, partial):
+        with self.condition:
+            task.partial = partial
+            listeners = [on_token for _, on_token in task.subscribers if on_token]
+        for listener in listeners:
+            listener(partial)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            futures = [
+                future for task in self.tasks.values() for future, _ in task.subscribers
+            ]
+            self.condition.notify_all()
+        for future in futures:
+            future.cancel()
+
+
+# Words that are never arguments and are always dropped
+QUERY_FILLER_WORDS = frozenset(
+    "please can could would should just you me we here there now currently".split()
+)
+# Dropped only in front of a vocabulary word ("delete the file" but not
+# "create folder a" or "copy a to b")
+QUERY_DETERMINERS = frozenset("a an the my this that these those some current i".split())
+# Dropped unless they are the last word
+QUERY_PREPOSITIONS = frozenset("to in on of for with".split())
+QUERY_SYNONYMS = {
+    "show": "list",
+    "display": "list",
+    "view": "list",
+    "directory": "folder",
+    "directories": "folders",
+    "dir": "folder",
+    "dirs": "folders",
+    "remove": "delete",
+    "erase": "delete",
+    "make": "create",
+    "goto": "go",
+}
+# Known words of shell requests. They are compared case-insensitively, every
+# other word is taken as a name and must match exactly, case included.
+QUERY_VOCABULARY = frozenset(
+    """
+    list print find search locate look get count check delete create new copy
+    move rename open edit change go cd enter leave back run start stop kill
+    restart install uninstall update upgrade download upload compress extract
+    archive unpack pack sort filter replace compare diff merge split join watch
+    monitor clear empty save write read append add set export sum total tail
+    head top tree link links
+    file files folder folders path paths name names extension extensions size
+    sizes disk disks space usage memory ram cpu process processes program
+    programs service services port ports network connection connections ip
+    address user users group groups permission permissions owner date time
+    line lines word words character characters content contents text output
+    log logs history environment variable variables screen terminal system
+    hidden every all each other last first recent recently modified changed old
+    older newer large larger largest big bigger biggest small smaller smallest
+    home parent previous up down working free running used available number day
+    days hour hours minute minutes week weeks month months today yesterday
+    and or not than more less from into inside within under over by as is are
+    am where what which how many much who when about containing contains named
+    called ending ends starting starts including except only recursively
+    recursive sorted per
+    """.split()
+) | frozenset(QUERY_SYNONYMS)
+QUERY_TOKEN_RE = re.compile(r"'([^']*)'|\"([^\"]*)\"|(\S+)")
+
+
+def is_literal_token(token):
+    # Names, numbers and paths must match exactly for a similar query to count
+    return token.lower() not in QUERY_VOCABULARY
+
+
+def clean_word(word):
+    word = word.strip(",;:!?()[]")
+    # Keep ".", ".." and paths, but drop sentence-ending dots
+    if word.strip("."):
+        word = word.rstrip(".")
+    return word
+
+
+def normalize_query(query):
+    # (lower-cased word, word as kept, is a vocabulary word)
+    tokens = []
+    for quoted, double_quoted, word in QUERY_TOKEN_RE.findall(query):
+        if not word:
+            tokens.append((None, quoted or double_quoted, False))
+            continue
+        word = clean_word(word)
+        lowered = QUERY_SYNONYMS.get(word.lower(), word.lower())
+        if lowered in QUERY_VOCABULARY:
+            tokens.append((lowered, lowered, True))
+        elif word and lowered not in QUERY_FILLER_WORDS:
+            # Paths and file names are case sensitive
+            tokens.append((lowered, word, False))
+
+    words = []
+    for index, (lowered, word, known) in enumerate(tokens):
+        following = tokens[index + 1] if index + 1 < len(tokens) else None
+        if not known and following:
+            if lowered in QUERY_PREPOSITIONS:
+                continue
+            if lowered in QUERY_DETERMINERS and following[2]:
+                continue
+        words.append(word)
+    return " ".join(words)
+
+
+class QueryIndex:
+    """TF-IDF similarity index over the normalized queries of one namespace."""
+
+    def __init__(self):
+        self.documents = {}
+        self.postings = {}
+
+    def add(self, normalized):
+        if normalized in self.documents:
+            return
+        tokens = frozenset(normalized.split())
+        self.documents[normalized] = tokens
+        for token in tokens:
+            self.postings.setdefault(token, set()).add(normalized)
+
+    def remove(self, normalized):
+        for token in self.documents.pop(normalized, ()):
+            self.postings[token].discard(normalized)
+            if not self.postings[token]:
+                del self.postings[token]
+
+    def idf(self, token):
+        size = len(self.documents)
+        return math.log((size + 1) / (len(self.postings.get(token, ())) + 1)) + 1
+
+    def lookup(self, normalized, threshold):
+        tokens = frozenset(normalized.split())
+        literals = {token for token in tokens if is_literal_token(token)}
+        candidates = set()
+        for token in tokens:
+            candidates.update(self.postings.get(token, ()))
+
+        weights = {token: self.idf(token) for token in tokens}
+        norm = math.sqrt(sum(w * w for w in weights.values()))
+        best, best_score = None, threshold
+        for candidate in candidates:
+            other = self.documents[candidate]
+            if literals != {token for token in other if is_literal_token(token)}:
+                continue
+            other_norm = math.sqrt(sum(self.idf(t) ** 2 for t in other))
+            dot = sum(weights[t] ** 2 for t in tokens & other)
+            score = dot / (norm * other_norm) if norm and other_norm else 0
+            if score >= best_score:
+                best, best_score = candidate, score
+        return best
+
+
+class CommandCache:
+    """Persistent query -> command cache with an LRU size cap and a TTL.
+
+    Queries are normalized before lookup, and with a similarity threshold
+    above 0 a miss falls back to the closest cached query.
+    """
+
+    SCHEMA_VERSION = 4
+
+    def __init__(
+        self, path, max_entries=2000, ttl=7 * 24 * 3600, similarity_threshold=0.0
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        # It is only a cache: older layouts are dropped rather than migrated
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != self.SCHEMA_VERSION:
+            self.db.execute("DROP TABLE IF EXISTS commands")
+            self.db.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS commands ("
+            "key TEXT PRIMARY KEY, namespace TEXT, query TEXT, command TEXT, "
+            "meta TEXT, created REAL, last_used REAL, hits INTEGER DEFAULT 0)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS commands_last_used ON commands (last_used)"
+        )
+        self.db.commit()
+
+        for namespace, query in self.db.execute(
+            "SELECT namespace, query FROM commands"
+        ):
+            self.indexes.setdefault(namespace, QueryIndex()).add(query)
+
+    @staticmethod
+    def hash_namespace(namespace):
+        return hashlib.sha256(json.dumps(namespace).encode()).hexdigest()
+
+    @staticmethod
+    def make_key(namespace_hash, normalized):
+        return hashlib.sha256(f"{namespace_hash}\0{normalized}".encode()).hexdigest()
+
+    def get(self, namespace, query, record=True):
+        # Speculative lookups pass record=False to leave hit/miss counters alone
+        namespace_hash = self.hash_namespace(namespace)
+        normalized = normalize_query(query)
+        with self.lock, METRICS.span("cache_lookup"):
+            command = self._get(namespace_hash, normalized)
+            if command is not None:
+                self.hits += record
+                METRICS.incr("cache_hits", record)
+                return command
+
+            index = self.indexes.get(namespace_hash)
+            if self.similarity_threshold > 0 and index:
+                similar = index.lookup(normalized, self.similarity_threshold)
+                if similar is not None:
+                    command = self._get(namespace_hash, similar)
+                    if command is not None:
+                        self.similar_hits += record
+                        METRICS.incr("cache_similar_hits", record)
+                        return command
+
+            self.misses += record
+            METRICS.incr("cache_misses", record)
+            return None
+
+    def _get(self, namespace_hash, normalized):
+        key = self.make_key(namespace_hash, normalized)
+        now = time.time()
+        row = self.db.execute(
+            "SELECT command, created FROM commands WHERE key = ?", (key,)
+        ).fetchone()
+        if row and self.ttl and now - row[1] > self.ttl:
+            self.db.execute("DELETE FROM commands WHERE key = ?", (key,))
+            self.db.commit()
+            self.indexes.get(namespace_hash, QueryIndex()).remove(normalized)
+            row = None
+
+        if row is None:
+            return None
+
+        self.db.execute(
+            "UPDATE commands SET last_used = ?, hits = hits + 1 WHERE key = ?",
+            (now, key),
+        )
+        self.db.commit()
+        return row[0]
+
+    def put(self, namespace, query, command, meta=None):
+        with METRICS.span("cache_store"):
+            self._put(namespace, query, command, meta)
+
+    def _put(self, namespace, query, command, meta):
+        namespace_hash = self.hash_namespace(namespace)
+        normalized = normalize_query(query)
+        key = self.make_key(namespace_hash, normalized)
+        now = time.time()
+        meta = json.dumps(meta) if meta is not None else None
+        with self.lock:
+            # Storing the same command again keeps its metadata (e.g. ranking)
+            self.db.execute(
+                "INSERT INTO commands "
+                "(key, namespace, query, command, meta, created, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET command = excluded.command, "
+                "meta = CASE WHEN excluded.command = commands.command "
+                "THEN COALESCE(excluded.meta, commands.meta) ELSE excluded.meta END, "
+                "created = excluded.created, last_used = excluded.last_used",
+                (key, namespace_hash, normalized, command, meta, now, now),
+            )
+            self.indexes.setdefault(namespace_hash, QueryIndex()).add(normalized)
+
+            size = self.db.execute("SELECT COUNT(*) FROM commands").fetchone()[0]
+            if size > self.max_entries:
+                evicted = self.db.execute(
+                    "SELECT key, namespace, query FROM commands "
+                    "ORDER BY last_used LIMIT ?",
+                    (size - self.max_entries,),
+                ).fetchall()
+                self.db.executemany(
+                    "DELETE FROM commands WHERE key = ?", [(k,) for k, _, _ in evicted]
+                )
+                for _, evicted_namespace, evicted_query in evicted:
+                    self.indexes[evicted_namespace].remove(evicted_query)
+            self.db.commit()
+
+    def frequent(self, namespace, limit, min_hits):
+        """Return the most hit (normalized query, command) pairs of a namespace."""
+        oldest = time.time() - self.ttl if self.ttl else 0
+        with self.lock:
+            return self.db.execute(
+                "SELECT query, command FROM commands WHERE namespace = ? "
+                "AND hits >= ? AND created >= ? ORDER BY hits DESC LIMIT ?",
+                (self.hash_namespace(namespace), min_hits, oldest, limit),
+            ).fetchall()
+
+    def clear(self):
+        with self.lock:
+            removed = self.db.execute("DELETE FROM commands").rowcount
+            self.db.commit()
+            self.indexes.clear()
+            self.hits = 0
+            self.similar_hits = 0
+            self.misses = 0
+        return removed
+
+    def stats(self):
+        with self.lock:
+            size = self.db.execute("SELECT COUNT(*) FROM commands").fetchone()[0]
+        return {
+            "entries": size,
+            "hits": self.hits,
+            "similar_hits": self.similar_hits,
+            "misses": self.misses,
+        }
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+NULL_REDIRECTS = ["> /dev/null 2>&1", "> /dev/null", "< /dev/null", ">/dev/null 2>&1"]
+
+# Infinite loop patterns, checked with a single combined regex
+LOOP_PATTERNS = [
+    ("while_true", r"while\s+true"),  # Matches "while true"
+    ("for_ever", r"for\s+\(\s*;?\s*;?\s*\)"),  # Matches "for (;;)" and variations
+    ("until_false", r"until\s+false"),  # Matches "until false"
+    ("while_colon", r"while\s+:"),  # Matches "while :"
+    ("colon_while_true", r":\s+while\s+true"),  # Matches ": while true"
+    ("while_number", r"while\s+\d+"),  # Matches "while 1", "while 42"
+    ("while_test_bracket", r"while\s+\[\s*.*?\s*\]"),  # Matches "while [ condition ]"
+    ("while_test", r"while\s+test\s+.*"),  # Matches "while test condition"
+    ("repeat_until", r"repeat\s+until\s+false"),  # Matches "repeat until false" (Lua style)
+    ("while_arith", r"while\s+\(\(.*?\)\)"),  # Matches "while ((condition))" (Bash arithmetic)
+]
+LOOP_RE = re.compile("|".join(f"(?P<{name}>{pattern})" for name, pattern in LOOP_PATTERNS))
+
+SUDO_MESSAGE = (
+    "#\n"
+    "# [ERROR] 'sudo' commands are blocked for safety reasons.\n"
+    "# If root permissions are required, consider running this program as root\n# (not recommended).\n"
+)
+LOOP_MESSAGE = "# Blocked: infinite loop detected."
+
+PolicyVerdict = namedtuple("PolicyVerdict", ["action", "rule", "reason"])
+
+SHELL_PUNCTUATION = "();<>|&`"
+# Commands that run their arguments as another command, with the options
+# that take a value and the number of arguments before the command
+WRAPPER_COMMANDS = {
+    "env": ({"-u", "--unset", "-C", "--chdir"}, 0),
+    "xargs": (
+        {
+            "-a", "--arg-file", "-d", "--delimiter", "-E", "-I", "-L",
+            "--max-lines", "-n", "--max-args", "-P", "--max-procs", "-s",
+            "--max-chars", "--process-slot-var",
+        },
+        0,
+    ),
+    "exec": ({"-a"}, 0),
+    "command": (set(), 0),
+    "builtin": (set(), 0),
+    "time": ({"-f", "--format", "-o", "--output"}, 0),
+    "timeout": ({"-s", "--signal", "-k", "--kill-after"}, 1),
+    "nohup": (set(), 0),
+    "nice": ({"-n", "--adjustment"}, 0),
+    "ionice": ({"-c", "--class", "-n", "--classdata"}, 0),
+    "stdbuf": ({"-i", "-o", "-e", "--input", "--output", "--error"}, 0),
+    "setsid": (set(), 0),
+    "coproc": (set(), 0),
+    "taskset": (set(), 1),
+    "flock": ({"-w", "--timeout", "-E", "--conflict-exit-code"}, 1),
+}
+# Commands that run their arguments as one shell command string
+STRING_COMMANDS = {"eval", "watch"}
+SHELLS = {"sh", "bash", "dash", "zsh", "ksh"}
+SHELL_VALUE_OPTIONS = {"-o", "+o", "-O", "+O", "--rcfile", "--init-file"}
+FIND_EXEC_ACTIONS = {"-exec", "-execdir", "-ok", "-okdir"}
+# Reserved words that can precede a command without being one
+SHELL_KEYWORDS = {"do", "then", "else", "elif", "!", "{", "}"}
+ASSIGNMENT_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*=")
+
+
+def command_substitutions(word):
+    """Return the commands inside $(...) and `...` in a (quoted) word."""
+    inner = []
+    index = 0
+    while index < len(word):
+        if word.startswith("$(", index):
+            depth, end = 1, index + 2
+            while end < len(word) and depth:
+                depth += {"(": 1, ")": -1}.get(word[end], 0)
+                end += 1
+            inner.append(word[index + 2 : end - 1])
+            index = end
+        elif word[index] == "`":
+            end = word.find("`", index + 1)
+            end = len(word) if end == -1 else end
+            inner.append(word[index + 1 : end])
+            index = end + 1
+        else:
+            index += 1
+    return inner
+
+
+def split_shell_commands(command):
+    """Split a command line into the simple commands bash would run.
+
+    Pipelines, ; && || & chains, subshells, $(...), backticks and <(...)
+    and >(...) process substitutions are all split apart, and so are the
+    commands run by wrappers (timeout, xargs, env, coproc...), eval, sh -c
+    and find -exec, so every command word can be checked on its own. Raises ValueError when the line cannot be tokenized
+    (e.g. unbalanced quotes).
+    """
+    lexer = shlex.shlex(command, posix=True, punctuation_chars=SHELL_PUNCTUATION)
+    lexer.whitespace_split = True
+    lexer.commenters = ""
+
+    commands, current = [], []
+    # Commands around open <(...) and >(...), with the subshells opened inside
+    nested = []
+    redirect_target = False
+    for token in lexer:
+        if token.startswith("#"):
+            break
+        if token[0] in SHELL_PUNCTUATION:
+            opens = token.endswith(("<(", ">("))
+            if opens:
+                token = token[:-2]
+            if "<" in token or ">" in token:
+                redirect_target = not token.endswith("&")
+            elif token:
+                for char in token:
+                    if current:
+                        commands.extend(expand_command(current))
+                        current = []
+                    if nested and char == "(":
+                        nested[-1][1] += 1
+                    elif nested and char == ")":
+                        if nested[-1][1]:
+                            nested[-1][1] -= 1
+                        else:
+                            # Back to the command the substitution is part of
+                            current = nested.pop()[0]
+            if opens:
+                # Process substitutions run a command of their own, like $(...)
+                nested.append([current, 0])
+                current = []
+                redirect_target = False
+            continue
+        if redirect_target:
+            redirect_target = False
+            continue
+
+        for inner in command_substitutions(token):
+            commands.extend(split_shell_commands(inner))
+        if token != "$" and (current or not ASSIGNMENT_RE.match(token)):
+            current.append(token)
+    while nested:
+        if current:
+            commands.extend(expand_command(current))
+        current = nested.pop()[0]
+    if current:
+        commands.extend(expand_command(current))
+    return commands
+
+
+def expand_command(words):
+    """Return a simple command followed by the commands it runs itself."""
+    commands = [words]
+    start = 0
+    while start < len(words) and words[start] in SHELL_KEYWORDS:
+        start += 1
+    if start == len(words):
+        return commands
+    name = os.path.basename(words[start])
+    arguments = words[start + 1 :]
+
+    if name in WRAPPER_COMMANDS:
+        value_options, positional = WRAPPER_COMMANDS[name]
+        if name == "coproc" and arguments[1:2] == ["{"]:
+            # coproc NAME { command; }
+            positional = 1
+        index = 0
+        while index < len(arguments):
+            word = arguments[index]
+            if word == "--":
+                index += 1
+                break
+            if name == "env" and word.startswith(("-S", "--split-string")):
+                # env -S runs its value as a command line
+                value = word[2:] if word.startswith("-S") else word.partition("=")[2]
+                script = ([value] if value else []) + arguments[index + 1 :]
+                commands.extend(split_shell_commands(" ".join(script)))
+                return commands
+            if word.startswith("-") and len(word) > 1:
+                index += 2 if word in value_options else 1
+            elif name == "env" and ASSIGNMENT_RE.match(word):
+                index += 1
+            elif positional:
+                positional -= 1
+                index += 1
+            else:
+                break
+        if index < len(arguments):
+            commands.extend(expand_command(arguments[index:]))
+    elif name in STRING_COMMANDS:
+        script = arguments
+        if name == "watch":
+            # Options and interval values come first
+            while script and script[0].startswith("-"):
+                script = script[2:] if script[0] in ("-n", "--interval") else script[1:]
+        commands.extend(split_shell_commands(" ".join(script)))
+    elif name in SHELLS:
+        index = 0
+        while index < len(arguments) and arguments[index][:1] in ("-", "+"):
+            word = arguments[index]
+            if word in SHELL_VALUE_OPTIONS:
+                index += 2
+                continue
+            index += 1
+            if not word.startswith("--") and "c" in word:
+                # The first argument after the options is the command string
+                while index < len(arguments) and arguments[index][:1] in ("-", "+"):
+                    index += 2 if arguments[index] in SHELL_VALUE_OPTIONS else 1
+                if index < len(arguments):
+                    commands.extend(split_shell_commands(arguments[index]))
+                break
+    elif name == "find":
+        inner = None
+        for word in arguments:
+            if inner is not None:
+                if word in (";", "+"):
+                    commands.extend(expand_command(inner))
+                    inner = None
+                else:
+                    inner.append(word)
+            elif word in FIND_EXEC_ACTIONS:
+                inner = []
+        if inner:
+            commands.extend(expand_command(inner))
+    return commands
+
+
+def runs_commands(words):
+    """Whether a simple command runs some of its arguments as a command."""
+    name = next(command_words(words), None)
+    return (
+        name in WRAPPER_COMMANDS
+        or name in STRING_COMMANDS
+        or name in SHELLS
+        or (name == "find" and not FIND_EXEC_ACTIONS.isdisjoint(words))
+    )
 
-def load_command_list(filename):
-    filepath = os.path.join(os.path.dirname(os.path.abspath(__file__)), filename)
 
+def command_words(words):
+    """Yield the executable name of a simple command."""
+    for word in words:
+        if word.startswith("-") or word in SHELL_KEYWORDS:
+            continue
+        yield os.path.basename(word)
+        return
+
+
+def strip_null_redirects(command):
+    for redirect in NULL_REDIRECTS:
+        command = command.replace(redirect, "")
+    return command
+
+
+class PatternAutomaton:
+    """Aho-Corasick automaton: finds any of many literal patterns in one pass."""
+
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [None]
+
+        for pattern in patterns:
+            state = 0
+            for char in pattern:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(None)
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            if self.output[state] is None:
+                self.output[state] = pattern
+
+        pending = deque(self.goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for char, child in self.goto[state].items():
+                pending.append(child)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                if self.output[child] is None:
+                    self.output[child] = self.output[self.fail[child]]
+
+    def search(self, text):
+        state = 0
+        for char in text:
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            if self.output[state] is not None:
+                return self.output[state]
+        return None
+
+    def match_prefix(self, text):
+        state = 0
+        for char in text:
+            state = self.goto[state].get(char)
+            if state is None:
+                return None
+            if self.output[state] is not None:
+                return self.output[state]
+        return None
+
+
+class CommandPolicy:
+    """Compiled blacklist/whitelist/loop checks for generated commands.
+
+    The lists come from a ConfigStore and are recompiled when it reports a
+    change.
+    """
+
+    MEMO_SIZE = 4096
+
+    def __init__(self, store):
+        self.store = store
+        self.memo = {}
+        self.lock = threading.Lock()
+        self.load_lists()
+        store.subscribe(self.on_change)
+
+    def on_change(self, name):
+        if name in ("blocked", "whitelisted"):
+            self.load_lists()
+
+    def load_lists(self):
+        lists = {
+            list_type: [
+                entry
+                for entry in self.store.commands(list_type)
+                if not entry.startswith("#")
+            ]
+            for list_type in ("blocked", "whitelisted")
+        }
+        with self.lock:
+            # Plain command names are matched against command words, anything
+            # else (options, redirections, fork bombs) as a literal substring
+            self.blocked_words = {
+                entry for entry in lists["blocked"] if re.fullmatch(r"[\w.+-]+", entry)
+            }
+            self.blocked = PatternAutomaton(
+                entry for entry in lists["blocked"] if entry not in self.blocked_words
+            )
+            self.whitelisted_words = {
+                entry
+                for entry in lists["whitelisted"]
+                if re.fullmatch(r"[\w.+-]+", entry)
+            }
+            self.whitelisted = PatternAutomaton(
+                entry
+                for entry in lists["whitelisted"]
+                if entry not in self.whitelisted_words
+            )
+            self.memo.clear()
+
+    def check(self, command):
+        with METRICS.span("policy_check"):
+            return self._check(command)
+
+    def _check(self, command):
+        # Memoized per normalized command, so spacing differences share a verdict
+        normalized = " ".join(command.split())
+        with self.lock:
+            verdict = self.memo.get(normalized)
+            if verdict is None:
+                verdict = self.classify(normalized)
+                if len(self.memo) >= self.MEMO_SIZE:
+                    self.memo.clear()
+                self.memo[normalized] = verdict
+        return verdict
+
+    def classify(self, command):
+        try:
+            commands = split_shell_commands(command)
+        except ValueError as e:
+            return PolicyVerdict("review", "parse-error", str(e))
+
+        names = [name for words in commands for name in command_words(words)]
+        if "sudo" in names:
+            return PolicyVerdict("block", "sudo", SUDO_MESSAGE)
+
+        loop = LOOP_RE.search(command)
+        if loop:
+            return PolicyVerdict("block", f"loop:{loop.lastgroup}", LOOP_MESSAGE)
+
+        # An option the parser does not know could hide the command a wrapper
+        # runs, so a blacklisted name anywhere in its arguments needs a review
+        for words in commands:
+            if runs_commands(words):
+                for word in words[1:]:
+                    name = os.path.basename(word)
+                    if name in self.blocked_words:
+                        return PolicyVerdict("review", f"blacklist:{name}", None)
+
+        # Every command in the line must be whitelisted to skip the review
+        allowed = [
+            self.whitelisted_words.issuperset(command_words(words))
+            or self.whitelisted.match_prefix(" ".join(words)) is not None
+            for words in commands
+        ]
+        if commands and all(allowed):
+            return PolicyVerdict("allow", "whitelist", None)
+
+        for words, is_allowed in zip(commands, allowed):
+            if is_allowed:
+                continue
+            for name in command_words(words):
+                if name in self.blocked_words:
+                    return PolicyVerdict("review", f"blacklist:{name}", None)
+        blocked = self.blocked.search(command)
+        if blocked is not None:
+            return PolicyVerdict("review", f"blacklist:{blocked}", None)
+
+        return PolicyVerdict("allow", None, None)
+
+
+class ToolIndex:
+    """Executables on $PATH with their man page summaries, persisted on disk.
+
+    Directories are only rescanned when their mtime changes, so refreshing
+    at startup is cheap. Summaries come from whatis when it is available.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.dirs = {}
+        self.dir_tools = {}
+        self.summaries = {}
+        self.postings = {}
+        try:
+            with open(path, "r") as file:
+                data = json.load(file)
+            if data.get("version") == self.VERSION:
+                self.dirs = data["dirs"]
+                self.dir_tools = data["dir_tools"]
+                self.summaries = data["summaries"]
+        except (OSError, ValueError, KeyError):
+            pass
+        self.build_postings()
+
+    def build_postings(self):
+        postings = {}
+        for name, summary in self.summaries.items():
+            for word in set(normalize_query(summary or "").lower().split()):
+                postings.setdefault(word, []).append(name)
+        with self.lock:
+            self.postings = postings
+
+    def tools(self):
+        with self.lock:
+            return {name for names in self.dir_tools.values() for name in names}
+
+    def refresh(self):
+        path_dirs = [d for d in os.environ.get("PATH", "").split(os.pathsep) if d]
+        dirs, dir_tools, changed = {}, {}, False
+        for directory in dict.fromkeys(path_dirs):
+            try:
+                mtime = os.stat(directory).st_mtime_ns
+            except OSError:
+                continue
+            dirs[directory] = mtime
+            if self.dirs.get(directory) == mtime and directory in self.dir_tools:
+                dir_tools[directory] = self.dir_tools[directory]
+                continue
+            changed = True
+            try:
+                entries = os.scandir(directory)
+            except OSError:
+                continue
+            with entries:
+                dir_tools[directory] = sorted(
+                    entry.name
+                    for entry in entries
+                    if entry.is_file() and os.access(entry.path, os.X_OK)
+                )
+        changed = changed or set(dirs) != set(self.dirs)
+
+        names = {name for tools in dir_tools.values() for name in tools}
+        summaries = {n: s for n, s in self.summaries.items() if n in names}
+        missing = sorted(names - set(summaries))
+        summaries.update(self.read_summaries(missing))
+        changed = changed or bool(missing) or len(summaries) != len(self.summaries)
+
+        with self.lock:
+            self.dirs, self.dir_tools, self.summaries = dirs, dir_tools, summaries
+        if changed:
+            self.build_postings()
+            self.save()
+
+    @staticmethod
+    def read_summaries(names):
+        summaries = dict.fromkeys(names, "")
+        whatis = shutil.which("whatis")
+        if not whatis:
+            return summaries
+        for start in range(0, len(names), 200):
+            try:
+                output = subprocess.run(
+                    [whatis, "--", *names[start : start + 200]],
+                    capture_output=True,
+                    text=True,
+                    timeout=30,
+                ).stdout
+            except (OSError, subprocess.TimeoutExpired):
+                break
+            # "ls (1)               - list directory contents"
+            for line in output.splitlines():
+                name, _, summary = line.partition(" - ")
+                name = name.split(" (")[0].strip()
+                if name in summaries and not summaries[name]:
+                    summaries[name] = summary.strip()
+        return summaries
+
+    def save(self):
+        with self.lock:
+            data = {
+                "version": self.VERSION,
+                "dirs": self.dirs,
+                "dir_tools": self.dir_tools,
+                "summaries": self.summaries,
+            }
+        temp_path = f"{self.path}.tmp"
+        try:
+            with open(temp_path, "w") as file:
+                json.dump(data, file)
+            os.replace(temp_path, self.path)
+        except OSError:
+            pass
+
+    def search(self, query, limit=5):
+        words = normalize_query(query).lower().split()
+        with self.lock:
+            summaries, postings = self.summaries, self.postings
+        scores = {}
+        for word in words:
+            if word in summaries:
+                scores[word] = scores.get(word, 0) + 10
+            matches = postings.get(word, ())
+            for name in matches:
+                # Rare words say more about a tool than common ones
+                scores[name] = scores.get(name, 0) + 1 / len(matches)
+        ranked = sorted(scores, key=lambda name: (-scores[name], len(name)))
+        return [(name, summaries.get(name, "")) for name in ranked[:limit]]
+
+    def context(self, query, max_tokens):
+        lines = []
+        for name, summary in self.search(query):
+            line = f"{name}: {summary}" if summary else name
+            if estimate_tokens("\n".join(lines + [line])) > max_tokens:
+                break
+            lines.append(line)
+        return "\n".join(lines)
+
+
+# Common intents answered locally, matched against the normalized query.
+# {name} placeholders are filled from the named group, shell-quoted. An
+# optional third element must also be found in the query as typed, for cues
+# that normalization drops. Commands typed as-is are never rewritten.
+INTENT_TEMPLATES = [
+    (r"(?:list )?files|ls", "ls"),
+    (r"(?:list )?all files", "ls -a"),
+    (r"(?:list )?(?:hidden|every) files|files including hidden", "ls -la"),
+    (r"(?:list )?files (?P<path>[~./]\S*)", "ls {path}"),
+    (r"(?:go|change|cd)(?: folder)? (?:home|~)(?: folder)?|home", "cd ~"),
+    (r"(?:go|change|cd)(?: folder)? (?:back|up|parent)(?: folder)?", "cd .."),
+    (r"(?:go|change|cd)(?: folder)? previous(?: folder)?", "cd -"),
+    (r"cd (?P<path>\S+)", "cd {path}"),
+    (r"(?:go|change)(?: folder)? (?P<path>[~./]\S*|\S+/\S*)", "cd {path}"),
+    (r"(?:go|change) folder (?P<path>\S+)", "cd {path}"),
+    (r"(?:go|change) (?P<path>\S+)", "cd {path}", r"\b(?:go|change)\s+to\s"),
+    (r"where am(?: i)?|(?:print |list )?working folder|pwd", "pwd"),
+    (r"(?:list )?(?:free )?disk (?:usage|space)", "df -h"),
+    (r"(?:list )?(?:free )?memory(?: usage)?", "free -h"),
+    (r"(?:list )?(?:running )?processes", "ps aux"),
+    (r"clear(?: screen| terminal)?", "clear"),
+    (r"create folder (?P<name>\S+)", "mkdir {name}"),
+    (r"create file (?P<name>\S+)", "touch {name}"),
+    (r"delete file (?P<name>\S+)", "rm {name}"),
+    (r"delete folder (?P<name>\S+)", "rm -r {name}"),
+    (r"(?:list |print )?(?:content|contents) (?:file )?(?P<name>\S*\.\S+)", "cat {name}"),
+]
+
+
+class IntentMatcher:
+    """Answers common queries locally before they reach the LLM.
+
+    Built-in templates are compiled into one regex; the most frequently hit
+    cached queries are added as exact matches.
+    """
+
+    def __init__(self, templates=INTENT_TEMPLATES):
+        self.commands = []
+        self.cues = []
+        alternatives = []
+        for index, (pattern, command, *cue) in enumerate(templates):
+            # Group names must be unique across the combined regex
+            pattern = re.sub(r"\(\?P<(\w+)>", rf"(?P<i{index}_\1>", pattern)
+            alternatives.append(f"(?P<i{index}>{pattern})")
+            self.commands.append(command)
+            self.cues.append(re.compile(cue[0], re.IGNORECASE) if cue else None)
+        self.regex = re.compile("^(?:" + "|".join(alternatives) + ")$")
+        self.learned = {}
+        self.lookups = 0
+        self.hits = 0
+        self.learned_hits = 0
+
+    def learn(self, pairs):
+        self.learned = dict(pairs)
+
+    def match(self, query, record=True):
+        normalized = normalize_query(query)
+        self.lookups += record
+        command = self.learned.get(normalized)
+        if command is not None:
+            self.learned_hits += record
+            METRICS.incr("fast_path_hits", record)
+            return command
+
+        match = self.regex.match(normalized)
+        if match is None:
+            return None
+        index = int(match.lastgroup[1:])
+        cue = self.cues[index]
+        if cue is not None and not cue.search(query):
+            return None
+        prefix = f"i{index}_"
+        arguments = {
+            name[len(prefix) :]: value
+            for name, value in match.groupdict().items()
+            if name.startswith(prefix) and value is not None
+        }
+        if not all(is_plain_argument(value, query) for value in arguments.values()):
+            return None
+        self.hits += record
+        METRICS.incr("fast_path_hits", record)
+        return self.commands[index].format(
+            **{name: quote_argument(value) for name, value in arguments.items()}
+        )
+
+    def stats(self):
+        answered = self.hits + self.learned_hits
+        return {
+            "lookups": self.lookups,
+            "template_hits": self.hits,
+            "learned_hits": self.learned_hits,
+            "learned_entries": len(self.learned),
+            "hit_rate": answered / self.lookups if self.lookups else 0.0,
+        }
+
+
+INTENT_UNSAFE_CHARS = frozenset(";&|<>()$`\\\"'*?[]{}!#")
+
+
+def is_plain_argument(value, query):
+    """Whether a template argument is the query's last word, as typed.
+
+    Anything the shell would interpret, option-like words, unquoted vocabulary
+    words ("change permissions") and arguments that lost words to
+    normalization are left to the LLM.
+    """
+    if value.startswith("-") or not INTENT_UNSAFE_CHARS.isdisjoint(value):
+        return False
+    quoted, double_quoted, word = QUERY_TOKEN_RE.findall(query)[-1]
+    if word:
+        word = clean_word(word)
+        return value == word and word.lower() not in QUERY_VOCABULARY
+    return value == (quoted or double_quoted)
+
+
+def quote_argument(value):
+    # ~ is only expanded when it is not quoted
+    if value == "~" or value.startswith("~/"):
+        return "~/" + shlex.quote(value[2:]) if value[2:] else value
+    return shlex.quote(value)
+
+
+def log_add(a, b):
+    # log(exp(a) + exp(b)) without overflowing
+    if a < b:
+        a, b = b, a
+    return a + math.log1p(math.exp(b - a))
+
+
+class QueryHistory:
+    """Query history kept in an append-only JSONL log, searchable in memory.
+
+    Entries are ranked by frecency: every use adds a weight that halves each
+    HALF_LIFE seconds. Weights are summed in log space, so scores never need
+    refreshing as time passes. Prefix lookups bisect a sorted key array, word
+    lookups use postings of entry ranks in frecency order. The indexes are
+    built on the first lookup, or earlier through build_index().
+    """
+
+    HALF_LIFE = 7 * 24 * 3600
+    # Search tokens that start more words than this are not looked up, only
+    # checked on the entries found through the other tokens
+    MAX_WORD_SPAN = 64
+    # Cost of checking one entry against the search, relative to one set
+    # operation on a posting
+    SCAN_COST = 5
+
+    def __init__(self, path, max_entries=10000):
+        self.path = path
+        self.max_entries = max_entries
+        self.records = deque(maxlen=max_entries)
+        self.timeline = []
+        self.scores = {}
+        self.keys = []
+        self.words = []
+        self.postings = {}
+        self.ranked = []
+        self.updated = set()
+        self.indexed = False
+        self.lines = 0
+        self.load()
+
+    def weight(self, timestamp):
+        return timestamp * math.log(2) / self.HALF_LIFE
+
+    def load(self):
+        try:
+            with open(self.path, "r") as file:
+                lines = [line for line in file if line.strip()]
+            self.lines = len(lines)
+            try:
+                # One decode for the whole log is several times faster
+                records = json.loads("[" + ",".join(lines) + "]")
+            except ValueError:
+                # A torn last line after a crash
+                records = []
+                for line in lines:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        continue
+            for record in records:
+                try:
+                    self.records.append((float(record["t"]), record["q"]))
+                except (KeyError, TypeError, ValueError):
+                    continue
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            show_error("Error", f"Could not read history: {e}")
+
+        for timestamp, query in self.records:
+            if not self.timeline or self.timeline[-1] != query:
+                self.timeline.append(query)
+            score = self.scores.get(query)
+            weight = self.weight(timestamp)
+            self.scores[query] = weight if score is None else log_add(score, weight)
+        if self.lines > len(self.records) * 2:
+            self.compact()
+
+    def build_index(self):
+        if self.indexed:
+            return
+        self.indexed = True
+        # Indexes are built in bulk, adding entries one by one is quadratic.
+        # Lower case with a leading space, so " " + token finds word prefixes
+        self.ranked = [
+            (query, " " + query.lower())
+            for query in sorted(self.scores, key=self.scores.get, reverse=True)
+        ]
+        for rank, (_, padded) in enumerate(self.ranked):
+            for word in set(padded.split()):
+                self.postings.setdefault(word, []).append(rank)
+        self.words = sorted(self.postings)
+        self.keys = sorted((query.lower(), query) for query in self.scores)
+
+    def add(self, query, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        if not self.timeline or self.timeline[-1] != query:
+            self.timeline.append(query)
+            if len(self.timeline) > self.max_entries:
+                del self.timeline[0]
+
+        score = self.scores.get(query)
+        if score is None and self.indexed:
+            bisect.insort(self.keys, (query.lower(), query))
+            for word in set(query.lower().split()):
+                if word not in self.postings:
+                    bisect.insort(self.words, word)
+                    self.postings[word] = []
+        if score is None:
+            self.scores[query] = self.weight(timestamp)
+        else:
+            self.scores[query] = log_add(score, self.weight(timestamp))
+        if self.indexed:
+            # Out of place in self.ranked from now on, searched separately
+            self.updated.add(query)
+
+        self.records.append((timestamp, query))
+        try:
+            with open(self.path, "a") as file:
+                file.write(json.dumps({"t": timestamp, "q": query}) + "\n")
+            self.lines += 1
+            if self.lines > self.max_entries * 2:
+                self.compact()
+        except OSError as e:
+            show_error("Error", f"Could not save history: {e}")
+
+    def compact(self):
+        """Rewrite the log with only the newest max_entries records."""
+        temporary = f"{self.path}.tmp"
+        try:
+            with open(temporary, "w") as file:
+                for timestamp, query in self.records:
+                    file.write(json.dumps({"t": timestamp, "q": query}) + "\n")
+            os.replace(temporary, self.path)
+            self.lines = len(self.records)
+        except OSError as e:
+            show_error("Error", f"Could not compact history: {e}")
+
+    def scan(self, matches, limit, ranks=None, matched=False):
+        """Best matches, checking entries in frecency order until limit.
+
+        With matched, the ranked entries in ranks are known to match already;
+        queries added since the index was built are always checked.
+        """
+        # Entries not updated since loading are still in score order, so the
+        # first limit matches among them are their best ones
+        found = [query for query in self.updated if matches(" " + query.lower())]
+        count = 0
+        for rank in range(len(self.ranked)) if ranks is None else ranks:
+            if count >= limit:
+                break
+            query, padded = self.ranked[rank]
+            if query not in self.updated and (matched or matches(padded)):
+                found.append(query)
+                count += 1
+        return heapq.nlargest(limit, found, key=self.scores.get)
+
+    def suggest(self, prefix):
+        """Best query that starts with prefix and is longer, or None."""
+        key = prefix.lower()
+        if not key:
+            return None
+        self.build_index()
+        needle = " " + key
+
+        def matches(padded):
+            return padded.startswith(needle) and len(padded) > len(needle)
+
+        low = bisect.bisect_left(self.keys, (key,))
+        high = bisect.bisect_left(self.keys, (key + "\uffff",))
+        # Ranking the whole range costs more than a scan once it is larger
+        # than about sqrt(entries): its entries are then common
+        if (high - low) ** 2 <= max(4096, len(self.ranked)):
+            found = [
+                query for lower, query in self.keys[low:high] if len(lower) > len(key)
+            ]
+            return max(found, key=self.scores.get, default=None)
+        found = self.scan(matches, 1)
+        return found[0] if found else None
+
+    def search(self, text, limit=10):
+        """Queries containing words that start with every token of text."""
+        tokens = text.lower().split()
+        needles = [" " + token for token in tokens]
+        self.build_index()
+
+        def matches(padded):
+            for needle in needles:
+                if needle not in padded:
+                    return False
+            return True
+
+        postings = []
+        for token in tokens:
+            low = bisect.bisect_left(self.words, token)
+            high = bisect.bisect_left(self.words, token + "\uffff")
+            if low == high:
+                return []
+            if high - low <= self.MAX_WORD_SPAN:
+                lists = [self.postings[word] for word in self.words[low:high]]
+                postings.append((sum(map(len, lists)), lists))
+        if not postings:
+            return self.scan(matches, limit)
+        postings.sort(key=lambda item: item[0])
+
+        def ranks(lists):
+            if len(lists) == 1:
+                return lists[0]
+            # A query found through two words of the token comes up twice
+            return (rank for rank, _ in itertools.groupby(heapq.merge(*lists)))
+
+        # Walking the rarest token's postings in frecency order stops after
+        # about limit / (share matching the other tokens) entries, while
+        # intersecting touches every entry of every posting
+        size, lists = postings[0]
+        entries = max(1, len(self.ranked))
+        share = math.prod(min(1.0, other / entries) for other, _ in postings[1:])
+        walked = min(size, limit / max(share, 1 / entries))
+        if walked * len(needles) * self.SCAN_COST <= sum(s for s, _ in postings):
+            return self.scan(matches, limit, ranks(lists))
+
+        candidates = set(ranks(lists))
+        for _, lists in postings[1:]:
+            candidates.intersection_update(itertools.chain(*lists))
+        if len(postings) == len(tokens):
+            # Every token was looked up, all candidates match
+            return self.scan(matches, limit, sorted(candidates), matched=True)
+        return self.scan(matches, limit, sorted(candidates))
+
+
+BASH_BUILTINS = frozenset(
+    "alias bg bind break builtin cd command compgen complete continue declare "
+    "dirs disown echo enable eval exec exit export false fc fg getopts hash help "
+    "history jobs kill let local logout popd printf pushd pwd read readonly "
+    "return set shift shopt source suspend test times trap true type typeset "
+    "ulimit umask unalias unset wait . : [ [[ if for while until case select".split()
+)
+
+
+def validate_candidate(command, policy):
+    verdict = policy.check(command)
     try:
-        with open(filepath, "r") as file:
-            return [line.strip() for line in file if line.strip()]
-    except FileNotFoundError:
-        messagebox.showerror("File Missing", f"File {filename} is missing.")
+        syntax_ok = (
+            subprocess.run(
+                ["bash", "-n", "-c", command], capture_output=True, timeout=2
+            ).returncode
+            == 0
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        syntax_ok = False
+    try:
+        names = [
+            name for words in split_shell_commands(command) for name in command_words(words)
+        ]
+    except ValueError:
+        names = []
+    missing = [
+        name for name in names if name not in BASH_BUILTINS and shutil.which(name) is None
+    ]
+    return {
+        "command": command,
+        "verdict": verdict.action,
+        "rule": verdict.rule,
+        "syntax_ok": syntax_ok,
+        "missing": missing,
+    }
+
+
+def score_candidate(validation, votes):
+    # Agreement between samples counts, broken or blocked commands sink
+    score = 10 * votes
+    if validation["verdict"] == "block":
+        score -= 1000
+    elif validation["verdict"] == "review":
+        score -= 5
+    if not validation["syntax_ok"]:
+        score -= 100
+    score -= 30 * len(validation["missing"])
+    return score - len(validation["command"]) / 100
+
+
+class CandidateRanker:
+    """Generates several candidates, validates them locally and keeps the best.
+
+    Used in place of the LLMClient by the scheduler when candidates > 1.
+    """
+
+    def __init__(self, client, policy, cache, candidates):
+        self.client = client
+        self.policy = policy
+        self.cache = cache
+        self.candidates = candidates
+        self.validators = ThreadPoolExecutor(max_workers=candidates)
+
+    def ask(self, query, on_token=None, context=None):
+        responses = self.client.ask_candidates(query, self.candidates, context)
+        commands = [
+            strip_null_redirects(response.strip().split("\n")[0])
+            for response in responses
+            if response.strip() and not response.startswith("Error:")
+        ]
+        if not commands:
+            return responses[0] if responses else "Error: no candidates generated."
+
+        votes = Counter(commands)
+        validations = list(
+            self.validators.map(
+                lambda command: validate_candidate(command, self.policy), votes
+            )
+        )
+        for validation in validations:
+            validation["votes"] = votes[validation["command"]]
+            validation["score"] = score_candidate(validation, validation["votes"])
+        ranking = sorted(validations, key=lambda v: v["score"], reverse=True)
+
+        self.client.log("Ranking", ranking)
+        if self.cache is not None:
+            self.cache.put(
+                self.client.cache_namespace(cache_context(query, context)),
+                query,
+                ranking[0]["command"],
+                ranking,
+            )
+        return ranking[0]["command"]
+
+
+def limit_command(command, cpu_seconds=0, memory_mb=0):
+    """Prefix command with ulimit calls for its CPU time and memory limits.
+
+    The limits are set by the shell itself: a preexec_fn is not safe in a
+    process running other threads. A limit that is already lower is kept.
+    """
+    limits = []
+    if cpu_seconds:
+        # SIGXCPU at the soft limit, SIGKILL a little later
+        limits.append(f"ulimit -S -t {cpu_seconds}; ulimit -H -t {cpu_seconds + 5}")
+    if memory_mb:
+        limits.append(f"ulimit -v {memory_mb * 1024}")
+    if not limits:
+        return command
+    return "".join(f"{{ {limit}; }} 2>/dev/null\n" for limit in limits) + command
+
+
+def kill_process_group(process):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def run_limited(command, timeout, cpu_seconds=0, memory_mb=0):
+    """Run command in its own process group and return (exit code, output).
+
+    On timeout the whole group is killed, so children holding the pipes open
+    cannot keep the caller waiting.
+    """
+    with subprocess.Popen(
+        limit_command(command, cpu_seconds, memory_mb),
+        shell=True,
+        executable="/bin/bash",
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        errors="replace",
+        start_new_session=True,
+    ) as process:
+        try:
+            stdout, stderr = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            kill_process_group(process)
+            process.communicate()
+            raise
+    return process.returncode, stdout + stderr
+
+
+CommandResult = namedtuple(
+    "CommandResult",
+    ["command", "exit_code", "duration", "output_size", "output_tail", "timed_out"],
+)
+
+
+class CountingReader:
+    """Wraps a process pipe, counting the characters read and keeping a tail."""
+
+    def __init__(self, stream, tail_lines=50):
+        self.stream = stream
+        self.count = 0
+        self.tail = deque(maxlen=tail_lines)
+
+    def __iter__(self):
+        for line in self.stream:
+            self.count += len(line)
+            self.tail.append(line)
+            yield line
+
+    def close(self):
+        self.stream.close()
+
+
+class ManagedShell:
+    """Terminal backend used for a single command run by the executor.
+
+    Implements the interface of tkterm's InterpreterShell, but starts the
+    command in its own process group with rlimits and a wall-clock watchdog.
+    """
+
+    def __init__(self, timeout, cpu_seconds=0, memory_mb=0):
+        self.timeout = timeout
+        self.cpu_seconds = cpu_seconds
+        self.memory_mb = memory_mb
+        self.process = None
+        self.watchdog = None
+        self.timed_out = False
+
+    def execute(self, command):
+        process = subprocess.Popen(
+            limit_command(command, self.cpu_seconds, self.memory_mb),
+            cwd=os.getcwd(),
+            shell=True,
+            executable="/bin/bash",
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+            errors="ignore",
+            start_new_session=True,
+        )
+        process.stdout = CountingReader(process.stdout)
+        process.stderr = CountingReader(process.stderr)
+        self.process = process
+        if self.timeout:
+            self.watchdog = threading.Timer(self.timeout, self.kill)
+            self.watchdog.daemon = True
+            self.watchdog.start()
+        return process
+
+    def kill(self):
+        self.timed_out = True
+        kill_process_group(self.process)
+
+    def terminate(self, process):
+        # Ctrl-C in the terminal
+        kill_process_group(process)
+        process.wait()
+        return "", ""
+
+    def get_return_code(self, process):
+        if self.watchdog:
+            self.watchdog.cancel()
+        return process.poll()
+
+    def get_prompt(self):
+        return os.getcwd() + ">> "
+
+    def get_history(self):
         return []
 
+    def output_size(self):
+        if self.process is None:
+            return 0
+        return self.process.stdout.count + self.process.stderr.count
+
+    def output_tail(self):
+        if self.process is None:
+            return ""
+        return "".join(self.process.stdout.tail) + "".join(self.process.stderr.tail)
+
+
+class CommandExecutor:
+    """Runs commands on a terminal one at a time, in submission order.
+
+    Managed (AI-generated) commands get a wall-clock timeout and rlimits, and
+    each run is recorded with its exit status, duration and output size.
+    """
+
+    POLL_INTERVAL = 0.02
+
+    def __init__(
+        self,
+        terminal,
+        timeout=60,
+        cpu_seconds=30,
+        memory_mb=0,
+        history=100,
+        ready=None,
+    ):
+        self.terminal = terminal
+        # Commands wait while ready() is false
+        self.ready = ready
+        self.closed = threading.Event()
+        self.timeout = timeout
+        self.cpu_seconds = cpu_seconds
+        self.memory_mb = memory_mb
+        self.results = deque(maxlen=history)
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self.work, daemon=True)
+        self.worker.start()
+
+    def submit(self, command, managed=True):
+        future = Future()
+        self.queue.put((command, managed, future, time.perf_counter()))
+        return future
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            command, managed, future, submitted = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            METRICS.observe("command_queue_wait", time.perf_counter() - submitted)
+            try:
+                future.set_result(self.run(command, managed))
+            except Exception as e:
+                future.set_exception(e)
+
+    def current_screen(self):
+        # Sessions keep tkterm to one tab, ahead of its add-tab button
+        notebook = self.terminal.notebook
+        return notebook.nametowidget(notebook.tabs()[0])
+
+    def wait_idle(self, screen):
+        # tkterm clears terminalThread from the Tk loop once a command is done
+        while screen.terminalThread:
+            time.sleep(self.POLL_INTERVAL)
+
+    def wait_ready(self):
+        while self.ready and not self.ready() and not self.closed.is_set():
+            time.sleep(self.POLL_INTERVAL)
+
+    def run(self, command, managed):
+        self.wait_ready()
+        if self.closed.is_set():
+            return None
+        screen = self.current_screen()
+        self.wait_idle(screen)
+        if not managed:
+            screen.run_command(command)
+            self.wait_idle(screen)
+            return None
+
+        shell = ManagedShell(self.timeout, self.cpu_seconds, self.memory_mb)
+        previous = screen.currentInterpreter
+        screen.currentInterpreter = shell
+        start = time.perf_counter()
+        try:
+            screen.run_command(command)
+            self.wait_idle(screen)
+        finally:
+            screen.currentInterpreter = previous
+        duration = time.perf_counter() - start
+
+        # Without a process the terminal handled it itself (cd, clear)
+        exit_code = shell.process.returncode if shell.process else None
+        result = CommandResult(
+            command,
+            exit_code,
+            duration,
+            shell.output_size(),
+            shell.output_tail(),
+            shell.timed_out,
+        )
+        self.results.append(result)
+        METRICS.observe("command_run", duration)
+        if result.timed_out:
+            METRICS.incr("command_timeouts")
+            screen.run_command(f"# Killed: still running after {self.timeout}s.")
+            self.wait_idle(screen)
+        elif exit_code:
+            METRICS.incr("command_failures")
+        return result
+
+    def close(self):
+        self.closed.set()
+        self.queue.put(None)
+
+
+class HistorySearchWindow(tk.Toplevel):
+    """Incremental history search, opened with Ctrl-R in the query box."""
+
+    MAX_RESULTS = 10
+
+    def __init__(self, parent, history, text, on_select):
+        super().__init__(parent)
+        self.title("Search History")
+        self.geometry("500x260")
+        self.configure(bg="#2E2E2E")
+        self.transient(parent)
+        self.history = history
+        self.on_select = on_select
+        self.results = []
+
+        self.entry = tk.Entry(self, bg="#3C3C3C", fg="white", insertbackground="white")
+        self.entry.pack(fill="x", padx=10, pady=(10, 5))
+        self.entry.insert(0, text)
+        self.listbox = tk.Listbox(self, selectmode=tk.SINGLE, bg="#3C3C3C", fg="white")
+        self.listbox.pack(expand=True, fill="both", padx=10, pady=(0, 10))
+
+        self.entry.bind("<KeyRelease>", self.update_results)
+        self.entry.bind("<Control-r>", lambda e: self.move(1))
+        self.entry.bind("<Down>", lambda e: self.move(1))
+        self.entry.bind("<Up>", lambda e: self.move(-1))
+        self.entry.bind("<Return>", self.select)
+        self.listbox.bind("<Double-Button-1>", self.select)
+        self.bind("<Escape>", lambda e: self.destroy())
+        self.entry.focus_set()
+        self.update_results()
+
+    def update_results(self, event=None):
+        # Navigation keys and Ctrl-R move through the current results
+        if event is not None and (
+            event.keysym in ("Up", "Down", "Return") or event.state & 0x4
+        ):
+            return
+        self.results = self.history.search(self.entry.get(), self.MAX_RESULTS)
+        self.listbox.delete(0, tk.END)
+        for query in self.results:
+            self.listbox.insert(tk.END, query)
+        if self.results:
+            self.listbox.selection_set(0)
+
+    def move(self, step):
+        if self.results:
+            selection = self.listbox.curselection()
+            index = (selection[0] + step if selection else 0) % len(self.results)
+            self.listbox.selection_clear(0, tk.END)
+            self.listbox.selection_set(index)
+            self.listbox.see(index)
+        return "break"
+
+    def select(self, event=None):
+        selection = self.listbox.curselection()
+        if selection:
+            self.on_select(self.results[selection[0]])
+        self.destroy()
+        return "break"
+
+
+class Session:
+    """One terminal tab with its own command queue, folder and queries.
+
+    The working directory is process wide, so only the tab on screen uses
+    it; the others keep theirs in cwd. Their commands wait until they are
+    shown again.
+    """
+
+    def __init__(self, app, name, cwd, queries, limits):
+        self.app = app
+        self.name = name
+        self.cwd = cwd
+        self.frame = tk.Frame(app.sessions_notebook, bg="#1E1E1E")
+        self.terminal = tkterm.Terminal(self.frame)
+        self.terminal.pack(expand=True, fill="both")
+        self.screen = None
+        self.hide_terminal_tabs()
+        self.executor = CommandExecutor(
+            self.terminal, ready=lambda: app.session is self, **limits
+        )
+        # Starts from the saved history, like a new shell
+        self.queries = list(queries)
+        self.history_index = len(self.queries)
+        self.pending_request = None
+        self.pending_partial = ""
+        self.query_started = None
+
+    def hide_terminal_tabs(self):
+        """Keep tkterm to the single tab of this session.
+
+        tkterm has its own tab bar, tab menu and tab shortcuts; tabs opened
+        there would bypass the session. They are hidden, and the shortcuts
+        open and cycle sessions instead.
+        """
+        notebook = self.terminal.notebook
+        ttk.Style().layout("Terminal.TNotebook.Tab", [])
+        notebook.frameNav.place_forget()
+        for sequence in ("<B1-Motion>", "<ButtonRelease-2>", "<Double-Button-1>"):
+            notebook.unbind(sequence)
+        # tkterm creates its first tab once the add-tab button is selected
+        notebook.bind("<<NotebookTabChanged>>", self.attach_screen, add="+")
+        self.attach_screen()
+
+    def attach_screen(self, event=None):
+        notebook = self.terminal.notebook
+        if self.screen is not None or len(notebook.tabs()) < 2:
+            return
+        self.screen = notebook.nametowidget(notebook.tabs()[0])
+        self.screen.bind("<<eventNewTab>>", self.app.new_session)
+        self.screen.bind("<<eventCycleNextTab>>", lambda e: self.app.cycle_session(1))
+        self.screen.bind("<<eventCyclePrevTab>>", lambda e: self.app.cycle_session(-1))
+
+    def add_query(self, query):
+        if not self.queries or self.queries[-1] != query:
+            self.queries.append(query)
+        self.history_index = len(self.queries)
+
+    def close(self):
+        if self.pending_request:
+            self.pending_request[2].cancel()
+            self.pending_request = None
+        self.executor.close()
+        self.frame.destroy()
+
 
 class CommandListEditor(tk.Toplevel):
-    def __init__(self, parent, list_type):
+    def __init__(self, parent, list_type, store):
         super().__init__(parent)
         self.title(f"Edit {list_type} Commands")
         self.geometry("500x400")
         self.configure(bg="#2E2E2E")
 
         self.list_type = list_type
-        self.file_path = os.path.join(
-            os.path.dirname(os.path.abspath(__file__)), f"{list_type}_commands.txt"
-        )
-
-        self.command_list = self.load_command_list()
+        self.store = store
+        self.command_list = store.commands(list_type)
 
         self.label = tk.Label(
             self, text=f"{list_type.capitalize()} Commands:", bg="#2E2E2E", fg="white"
@@ -184,13 +3021,10 @@ class CommandListEditor(tk.Toplevel):
         )
         self.save_button.pack(side="right", padx=5, pady=5)
 
-    def load_command_list(self):
-        if not os.path.exists(self.file_path):
-            with open(self.file_path, "w") as file:
-                pass
-
-        with open(self.file_path, "r") as file:
-            return [line.strip() for line in file if line.strip()]
+    def reload(self):
+        self.command_list = self.store.commands(self.list_type)
+        self.populate_listbox()
+        self.entry.delete(0, tk.END)
 
     def populate_listbox(self):
         self.listbox.delete(0, tk.END)
@@ -216,12 +3050,11 @@ class CommandListEditor(tk.Toplevel):
             messagebox.showwarning("Warning", "No command selected.")
 
     def save_commands(self):
-        with open(self.file_path, "w") as file:
-            file.write(
-                "\n".join(command.split()[0] for command in self.command_list) + "\n"
-            )
+        # Entries are kept whole: the policy matches multi-word ones literally
+        if not self.store.save_commands(self.list_type, self.command_list):
+            return
         messagebox.showinfo("Saved", "Command saved successfully.")
-        self.destroy()
+        self.withdraw()
 
 
 class AIEnhancedTerminalApp(tk.Tk):
@@ -230,13 +3063,64 @@ class AIEnhancedTerminalApp(tk.Tk):
         self.title("LAIB# Local AI Bash")
         self.geometry("800x600")
         self.configure(bg="#2E2E2E")
-        self.command_history = []
-        self.history_index = -1
-        self.cache = {}
+        STARTUP.mark("create window")
+        self.store = ConfigStore()
+        current_config = self.store.config()
+        self.history = QueryHistory(HISTORY_FILE, current_config.get("history_size", 10000))
+        self.history_suggestions = current_config.get("history_suggestions", True)
+        self.cache = CommandCache(
+            CACHE_FILE,
+            max_entries=current_config.get("cache_max_entries", 2000),
+            ttl=current_config.get("cache_ttl", 7 * 24 * 3600),
+            similarity_threshold=current_config.get("cache_similarity_threshold", 0.0),
+        )
+        self.llm_results = queue.Queue()
+        self.request_counter = 0
+        self.polling_results = False
+        self.prefetch_enabled = tk.BooleanVar(
+            value=current_config.get("speculative_prefetch", False)
+        )
+        self.prefetch_delay_ms = current_config.get("prefetch_delay_ms", 400)
+        self.prefetch_min_chars = current_config.get("prefetch_min_chars", 6)
+        self.prefetch_budget = current_config.get("prefetch_budget_per_minute", 10)
+        self.prefetch_times = deque()
+        self.prefetch_after_id = None
+        self.prefetch = None
+        self.context_tokens = current_config.get("context_tokens", 300)
+        self.context_commands = current_config.get("context_commands", 5)
+        self.metrics_file = current_config.get("metrics_file")
+        self.metrics_interval_ms = int(current_config.get("metrics_interval", 15) * 1000)
+        self.windows = {}
+        self.started = False
+        # Notebook tab id to Session; self.session is the one on screen
+        self.sessions = {}
+        self.session = None
+        self.session_counter = 0
+        self.command_limits = {
+            "timeout": current_config.get("command_timeout", 60),
+            "cpu_seconds": current_config.get("command_cpu_limit", 30),
+            "memory_mb": current_config.get("command_memory_limit_mb", 0),
+        }
+        STARTUP.mark("load config, history and cache")
         self.columnconfigure(0, weight=1)
         self.rowconfigure(0, weight=1)
         self.rowconfigure(1, weight=0)
-        self.http_queue = queue.Queue()
+        self.http_log = HTTPLog(current_config.get("http_log_size", 500))
+        self.tool_index = ToolIndex(TOOL_INDEX_FILE)
+        self.llm_client = LLMClient(current_config, self.http_log, self.tool_index)
+        self.policy = CommandPolicy(self.store)
+        generator = self.llm_client
+        if current_config.get("candidates", 1) > 1:
+            generator = CandidateRanker(
+                self.llm_client, self.policy, self.cache, current_config["candidates"]
+            )
+        self.scheduler = LLMScheduler(generator, current_config.get("llm_concurrency", 1))
+        self.intents = None
+        if current_config.get("fast_path", True):
+            self.intents = IntentMatcher()
+        self.fast_path_learned = current_config.get("fast_path_learned", 200)
+        self.fast_path_min_hits = current_config.get("fast_path_min_hits", 3)
+        STARTUP.mark("create llm client and policy")
 
         self.menu_bar = tk.Menu(self)
         self.config(menu=self.menu_bar)
@@ -254,18 +3138,35 @@ class AIEnhancedTerminalApp(tk.Tk):
         )
         settings_menu.add_command(
             label="Edit LMStudio Endpoint",
-            command=configure_endpoint,
+            command=self.edit_endpoint,
+        )
+        settings_menu.add_checkbutton(
+            label="Speculative Prefetch",
+            variable=self.prefetch_enabled,
+            command=self.toggle_prefetch,
+        )
+        session_menu = tk.Menu(self.menu_bar, tearoff=0, bg="#1E1E1E", fg="white")
+        self.menu_bar.add_cascade(label="Sessions", menu=session_menu)
+        session_menu.add_command(
+            label="New Tab", accelerator="Ctrl+Shift+T", command=self.new_session
         )
+        session_menu.add_command(
+            label="Close Tab", accelerator="Ctrl+Shift+W", command=self.close_session
+        )
+        self.bind("<Control-T>", self.new_session)
+        self.bind("<Control-W>", self.close_session)
         self.menu_bar.add_cascade(label="Help", menu=help_menu)
         help_menu.add_command(label="User Guide", command=self.show_help)
         help_menu.add_command(label="About", command=self.show_about)
-        self.terminal_frame = tk.Frame(self, bg="#1E1E1E")
-        self.terminal_frame.grid(row=0, column=0, sticky="nsew")
+        self.sessions_notebook = ttk.Notebook(self)
+        self.sessions_notebook.grid(row=0, column=0, sticky="nsew")
+        self.sessions_notebook.bind("<<NotebookTabChanged>>", self.switch_session)
         debug_menu = tk.Menu(self.menu_bar, tearoff=0, bg="#1E1E1E", fg="white")
         self.menu_bar.add_cascade(label="Debug", menu=debug_menu)
         debug_menu.add_command(label="API Debug", command=self.open_http_debug_window)
-        self.terminal = Terminal(self.terminal_frame)
-        self.terminal.pack(expand=True, fill="both")
+        debug_menu.add_command(label="Metrics", command=self.open_metrics_window)
+        debug_menu.add_command(label="Fast Path Stats", command=self.show_fast_path_stats)
+        STARTUP.mark("build menus")
 
         self.query_frame = tk.Frame(self, bg="#1E1E1E")
         self.query_frame.grid(row=1, column=0, sticky="ew")
@@ -273,7 +3174,7 @@ class AIEnhancedTerminalApp(tk.Tk):
         self.query_frame.columnconfigure(1, weight=0)
         self.query_label = tk.Label(
             self.query_frame,
-            text='Generate a command to... (e.g. "change to folder home" - "delete folder \'hi\'")',
+            text=QUERY_LABEL_TEXT,
             bg="#1E1E1E",
             fg="white",
         )
@@ -286,6 +3187,11 @@ class AIEnhancedTerminalApp(tk.Tk):
         self.query_entry.bind("<Return>", self.handle_ai_query)
         self.query_entry.bind("<Up>", self.navigate_history)
         self.query_entry.bind("<Down>", self.navigate_history)
+        self.query_entry.bind("<Escape>", self.cancel_ai_query)
+        self.query_entry.bind("<KeyRelease>", self.suggest_from_history)
+        self.query_entry.bind("<KeyRelease>", self.schedule_prefetch, add="+")
+        self.query_entry.bind("<Tab>", self.accept_suggestion)
+        self.query_entry.bind("<Control-r>", self.open_history_search)
 
         self.reset_cache_button = tk.Button(
             self.query_frame,
@@ -295,120 +3201,498 @@ class AIEnhancedTerminalApp(tk.Tk):
             fg="white",
         )
         self.reset_cache_button.grid(row=1, column=1, padx=5, pady=5)
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+        if self.metrics_file:
+            self.after(self.metrics_interval_ms, self.export_metrics)
+        self.store.subscribe(self.apply_config)
+        self.after(CONFIG_POLL_INTERVAL_MS, self.poll_config)
+        STARTUP.mark("build query bar")
+        self.new_session()
+        STARTUP.mark("build terminal")
+        # Idle callbacks draw the window, the timer they leave runs after
+        self.after_idle(self.after, 0, self.finish_startup)
+
+    def finish_startup(self):
+        """Work that is not needed to draw the window and take a query."""
+        if self.started:
+            return
+        self.started = True
+        self.history.build_index()
+        if self.intents:
+            self.intents.learn(
+                self.cache.frequent(
+                    self.llm_client.cache_namespace(),
+                    self.fast_path_learned,
+                    self.fast_path_min_hits,
+                )
+            )
+        threading.Thread(target=self.tool_index.refresh, daemon=True).start()
+        threading.Thread(target=self.llm_client.connect, daemon=True).start()
+
+    def show_window(self, key, create):
+        """Show the window kept under key, creating it on first use.
+
+        Closing such a window only hides it, so reopening it is instant.
+        """
+        window = self.windows.get(key)
+        if window is None or not window.winfo_exists():
+            window = create()
+            window.protocol("WM_DELETE_WINDOW", window.withdraw)
+            self.windows[key] = window
+        else:
+            window.deiconify()
+        window.lift()
+        return window
+
+    def new_session(self, event=None):
+        # A new tab starts in the folder of the current one
+        self.session_counter += 1
+        session = Session(
+            self,
+            f"Session {self.session_counter}",
+            os.getcwd(),
+            self.history.timeline,
+            self.command_limits,
+        )
+        self.sessions[str(session.frame)] = session
+        self.sessions_notebook.add(session.frame, text=session.name)
+        self.sessions_notebook.select(session.frame)
+        self.switch_session()
+        return "break"
+
+    def switch_session(self, event=None):
+        session = self.sessions.get(self.sessions_notebook.select())
+        if session is None or session is self.session:
+            return
+        if self.session is not None:
+            self.session.cwd = os.getcwd()
+        try:
+            os.chdir(session.cwd)
+        except OSError:
+            # Removed while the tab was in the background
+            session.cwd = os.getcwd()
+        self.session = session
+        self.update_pending_indicator()
+
+    def cycle_session(self, step):
+        tabs = self.sessions_notebook.tabs()
+        index = tabs.index(self.sessions_notebook.select())
+        self.sessions_notebook.select(tabs[(index + step) % len(tabs)])
+        return "break"
+
+    def close_session(self, event=None):
+        if len(self.sessions) > 1:
+            session = self.session
+            self.session = None
+            del self.sessions[str(session.frame)]
+            self.sessions_notebook.forget(session.frame)
+            session.close()
+            self.switch_session()
+        return "break"
+
+    def edit_endpoint(self):
+        configure_endpoint(self.store)
+
+    def poll_config(self):
+        self.store.poll()
+        self.after(CONFIG_POLL_INTERVAL_MS, self.poll_config)
+
+    def apply_config(self, name):
+        """Settings that take effect without a restart."""
+        if name != "config":
+            return
+        current_config = self.store.config()
+        self.llm_client.configure(current_config)
+        self.history_suggestions = current_config.get("history_suggestions", True)
+        self.prefetch_enabled.set(current_config.get("speculative_prefetch", False))
+        self.prefetch_delay_ms = current_config.get("prefetch_delay_ms", 400)
+        self.prefetch_min_chars = current_config.get("prefetch_min_chars", 6)
+        self.prefetch_budget = current_config.get("prefetch_budget_per_minute", 10)
+        self.context_tokens = current_config.get("context_tokens", 300)
+        self.context_commands = current_config.get("context_commands", 5)
 
     def open_http_debug_window(self):
-        HTTPDebugWindow(self, self.http_queue)
+        self.show_window(
+            "http_debug", lambda: HTTPDebugWindow(self, self.http_log, self.store)
+        )
+
+    def open_metrics_window(self):
+        self.show_window(
+            "metrics", lambda: MetricsWindow(self, METRICS, self.metrics_file)
+        )
+
+    def export_metrics(self):
+        try:
+            METRICS.export(self.metrics_file)
+        except OSError as e:
+            self.http_log.put("Error", f"Could not export metrics: {e}")
+        self.after(self.metrics_interval_ms, self.export_metrics)
 
     def open_command_list_editor(self, list_type):
-        CommandListEditor(self, list_type)
+        key = f"{list_type}_editor"
+        editor = self.windows.get(key)
+        if editor is not None and editor.winfo_exists():
+            # The review window may have changed the list since
+            editor.reload()
+        self.show_window(key, lambda: CommandListEditor(self, list_type, self.store))
 
     def handle_ai_query(self, event=None):
-        query = self.query_entry.get().strip()
+        # Enter submits what was typed, not the inline suggestion
+        query = self.typed_query()
+        if self.query_entry.selection_present():
+            self.query_entry.delete("sel.first", tk.END)
         if not query:
             return
 
-        if not self.command_history or query != self.command_history[-1]:
-            self.command_history.append(query)
-        self.history_index = len(self.command_history)
+        session = self.session
+        self.history.add(query)
+        session.add_query(query)
+
+        if self.prefetch_after_id:
+            self.after_cancel(self.prefetch_after_id)
+            self.prefetch_after_id = None
+
+        # A new query replaces the one still in flight, however it is answered
+        self.cancel_ai_query()
+        session.query_started = time.perf_counter()
+        METRICS.incr("queries")
+        with METRICS.span("fast_path"):
+            local = self.intents.match(query) if self.intents else None
+        if local is not None:
+            self.process_ai_response(query, local, session)
+            return
 
-        if query in self.cache:
-            ai_response = self.cache[query]
+        context = self.shell_context()
+        cached = self.cache.get(
+            self.llm_client.cache_namespace(cache_context(query, context)), query
+        )
+        if cached is not None:
+            self.process_ai_response(query, cached, session)
         else:
-            ai_response = ask_LLM(query, self.http_queue).strip()
-            self.cache[query] = ai_response
+            # A speculative request for the same query is coalesced and adopted
+            if self.prefetch and self.prefetch[0] == query:
+                self.prefetch = None
+            self.submit_ai_query(query, context)
+
+    def shell_context(self):
+        """Current folder, recent commands and last output for the prompt."""
+        if self.context_tokens <= 0:
+            return None
+        executor = self.session.executor
+        screen = executor.current_screen()
+        # tkterm keeps the newest command first; "#" lines are our own messages
+        commands = [
+            command
+            for command in screen.commandHistory
+            if not command.startswith("#")
+        ][: self.context_commands]
+
+        # Output is only known for commands run by the executor, and only
+        # relevant if nothing else was run since
+        output = ""
+        if commands and executor.results:
+            last = executor.results[-1]
+            if last.command == commands[0]:
+                output = last.output_tail
+        return build_shell_context(os.getcwd(), commands, output, self.context_tokens)
+
+    def typed_query(self):
+        # Without the inline suggestion still selected after the cursor
+        text = self.query_entry.get()
+        if (
+            self.query_entry.selection_present()
+            and self.query_entry.index("sel.last") == len(text)
+        ):
+            text = text[: self.query_entry.index("sel.first")]
+        return text.strip()
+
+    def suggest_from_history(self, event):
+        if not self.history_suggestions:
+            return
+        if not event.char or not event.char.isprintable() or event.state & 0x4:
+            return
+        typed = self.query_entry.get()
+        if (
+            self.query_entry.selection_present()
+            or self.query_entry.index(tk.INSERT) != len(typed)
+        ):
+            return
+        suggestion = self.history.suggest(typed)
+        if suggestion:
+            self.query_entry.insert(tk.END, suggestion[len(typed) :])
+            self.query_entry.select_range(len(typed), tk.END)
+            self.query_entry.icursor(len(typed))
+
+    def accept_suggestion(self, event=None):
+        if not self.query_entry.selection_present():
+            return None
+        self.query_entry.selection_clear()
+        self.query_entry.icursor(tk.END)
+        return "break"
 
-        if ai_response:
-            first_line = ai_response.split("\n")[0]
-            first_word = first_line.split()[0]
-
-            if first_word == "sudo":
-                self.terminal.run_command(
-                    "#\n"
-                    "# [ERROR] 'sudo' commands are blocked for safety reasons.\n"
-                    "# If root permissions are required, consider running this program as root\n# (not recommended).\n"
-                )
-                return
+    def open_history_search(self, event=None):
+        def on_select(query):
+            self.query_entry.delete(0, tk.END)
+            self.query_entry.insert(0, query)
+            self.query_entry.focus_set()
 
-            dangerous_commands = load_command_list("blocked_commands.txt")
-            whitelisted_commands = load_command_list("whitelisted_commands.txt")
+        HistorySearchWindow(self, self.history, self.typed_query(), on_select)
+        return "break"
 
-            first_line = (
-                first_line.replace("> /dev/null 2>&1", "")
-                .replace("> /dev/null", "")
-                .replace("< /dev/null", "")
-                .replace(">/dev/null 2>&1", "")
-            )
-            # Check for infinite loop patterns with regex
-            loop_patterns = [
-                r"while\s+true",  # Matches "while true"
-                r"for\s+\(\s*;?\s*;?\s*\)",  # Matches "for (;;)" and variations
-                r"until\s+false",  # Matches "until false"
-                r"while\s+:",  # Matches "while :"
-                r":\s+while\s+true",  # Matches ": while true"
-                r"while\s+\d+",  # Matches "while 1", "while 42"
-                r"while\s+\[\s*.*?\s*\]",  # Matches "while [ condition ]"
-                r"while\s+test\s+.*",  # Matches "while test condition"
-                r"repeat\s+until\s+false",  # Matches "repeat until false" (Lua style)
-                r"while\s+\(\(.*?\)\)",  # Matches "while ((condition))" (Bash arithmetic)
-            ]
+    def next_request_id(self):
+        # A new query replaces whatever is still in flight in its tab
+        self.cancel_ai_query()
+        self.request_counter += 1
+        return self.request_counter
+
+    def submit_ai_query(self, query, context=None):
+        request_id = self.next_request_id()
+        future = self.scheduler.submit(
+            query,
+            PRIORITY_USER,
+            lambda partial: self.llm_results.put((request_id, "token", partial)),
+            context,
+        )
+        self.track_ai_query(request_id, query, future, context)
 
-            # Check if command matches any loop pattern
-            if any(re.search(pattern, first_line) for pattern in loop_patterns):
-                self.terminal.run_command("# Blocked: infinite loop detected.")
-                return
+    def track_ai_query(self, request_id, query, future, context=None):
+        self.session.pending_request = (request_id, query, future, context)
+        self.session.pending_partial = ""
+        future.add_done_callback(
+            lambda f: self.llm_results.put((request_id, "done", f))
+        )
+
+        self.update_pending_indicator()
+        if not self.polling_results:
+            self.polling_results = True
+            self.after(LLM_POLL_INTERVAL_MS, self.poll_llm_results)
 
-            if any(first_line.startswith(cmd) for cmd in whitelisted_commands):
-                self.run_terminal_command(first_line)
-            elif any(cmd in first_line for cmd in dangerous_commands):
-                self.show_warning_and_edit(first_line)
+    def toggle_prefetch(self):
+        self.store.update_config(speculative_prefetch=self.prefetch_enabled.get())
+
+    def schedule_prefetch(self, event=None):
+        if not self.prefetch_enabled.get():
+            return
+        if event is not None and event.keysym in ("Return", "Escape", "Up", "Down"):
+            return
+        # Debounce: only fire once typing pauses
+        if self.prefetch_after_id:
+            self.after_cancel(self.prefetch_after_id)
+        self.prefetch_after_id = self.after(self.prefetch_delay_ms, self.start_prefetch)
+
+    def start_prefetch(self):
+        self.prefetch_after_id = None
+        query = self.typed_query()
+        if len(query) < self.prefetch_min_chars:
+            return
+        pending = self.session.pending_request
+        if pending and pending[1] == query:
+            return
+        if self.prefetch and self.prefetch[0] == query:
+            return
+        if self.intents and self.intents.match(query, record=False) is not None:
+            return
+
+        # Only one speculative request at a time, so it never queues up behind
+        # a real one; the old one is dropped if it has not started yet
+        if self.prefetch and not self.prefetch[1].cancel() and not self.prefetch[1].done():
+            return
+
+        now = time.monotonic()
+        while self.prefetch_times and now - self.prefetch_times[0] > 60:
+            self.prefetch_times.popleft()
+        if len(self.prefetch_times) >= self.prefetch_budget:
+            return
+
+        context = self.shell_context()
+        namespace = self.llm_client.cache_namespace(cache_context(query, context))
+        if self.cache.get(namespace, query, record=False) is not None:
+            return
+
+        self.prefetch_times.append(now)
+        future = self.scheduler.submit(query, PRIORITY_PREFETCH, context=context)
+        self.prefetch = (query, future)
+
+        def store(f):
+            if not f.cancelled():
+                ai_response = f.result().strip()
+                if ai_response and not ai_response.startswith("Error:"):
+                    self.cache.put(namespace, query, ai_response)
+
+        future.add_done_callback(store)
+
+    def cancel_ai_query(self, event=None):
+        if self.session.pending_request:
+            self.session.pending_request[2].cancel()
+            self.session.pending_request = None
+            self.update_pending_indicator()
+        return "break" if event else None
+
+    def pending_session(self, request_id):
+        for session in self.sessions.values():
+            if session.pending_request and session.pending_request[0] == request_id:
+                return session
+        return None
+
+    def poll_llm_results(self):
+        try:
+            while True:
+                try:
+                    request_id, kind, payload = self.llm_results.get_nowait()
+                except queue.Empty:
+                    break
+
+                # Responses to cancelled or replaced requests are dropped
+                session = self.pending_session(request_id)
+                if session is None:
+                    continue
+                try:
+                    self.handle_llm_result(session, kind, payload)
+                except Exception as e:
+                    # One bad result must not stop the loop for later queries
+                    METRICS.incr("result_errors")
+                    session.pending_request = None
+                    session.query_started = None
+                    self.show_in_terminal(f"# Error: {e}", session)
+        finally:
+            if any(session.pending_request for session in self.sessions.values()):
+                self.after(LLM_POLL_INTERVAL_MS, self.poll_llm_results)
+                self.update_pending_indicator()
             else:
-                self.run_terminal_command(first_line)
+                self.polling_results = False
 
-        self.query_entry.delete(0, tk.END)
+    def handle_llm_result(self, session, kind, payload):
+        if kind == "token":
+            session.pending_partial = payload.split("\n")[0]
+            return
+
+        query, future = session.pending_request[1], payload
+        context = session.pending_request[3]
+        session.pending_request = None
+        self.update_pending_indicator()
+        if future.cancelled():
+            return
+
+        ai_response = future.result().strip()
+        if not ai_response:
+            ai_response = "Error: the model returned an empty response."
+        if ai_response.startswith("Error:"):
+            session.query_started = None
+            self.show_in_terminal(f"# {ai_response}", session)
+            return
+        self.cache.put(
+            self.llm_client.cache_namespace(cache_context(query, context)),
+            query,
+            ai_response,
+        )
+        self.process_ai_response(query, ai_response, session)
+
+    def update_pending_indicator(self):
+        pending = self.session.pending_request
+        if pending:
+            frame = SPINNER_FRAMES[int(time.monotonic() * 10) % len(SPINNER_FRAMES)]
+            if self.session.pending_partial:
+                text = f"{frame} {self.session.pending_partial}█"
+            else:
+                text = f"{frame} Generating command for: {pending[1]}"
+            queued = self.scheduler.queue_depth()
+            if queued:
+                text += f"  [{queued} queued]"
+            text += "  (Esc to cancel)"
+            self.query_label.configure(text=text)
+        else:
+            self.query_label.configure(text=QUERY_LABEL_TEXT)
+
+    def process_ai_response(self, query, ai_response, session):
+        if ai_response:
+            first_line = strip_null_redirects(ai_response.split("\n")[0])
+            verdict = self.policy.check(first_line)
+            METRICS.incr(f"verdict_{verdict.action}")
+            if session.query_started is not None:
+                METRICS.observe(
+                    "query_total", time.perf_counter() - session.query_started
+                )
+                session.query_started = None
+
+            if verdict.action == "block":
+                self.show_in_terminal(verdict.reason, session)
+                return
+            if verdict.action == "review":
+                self.show_warning_and_edit(first_line, session)
+            else:
+                self.run_terminal_command(first_line, session)
+
+        # Keep anything typed while the request was in flight, or in another tab
+        if session is self.session and self.query_entry.get().strip() == query:
+            self.query_entry.delete(0, tk.END)
 
     def process_query(self, query):
-        response = ask_LLM(query, self.http_queue)
+        response = self.llm_client.ask(query)
         messagebox.showinfo("AI Response", response)
 
+    def show_fast_path_stats(self):
+        if self.intents is None:
+            messagebox.showinfo("Fast Path", "Fast path is disabled in config.json.")
+            return
+        stats = self.intents.stats()
+        messagebox.showinfo(
+            "Fast Path",
+            f"Queries: {stats['lookups']}\n"
+            f"Answered by templates: {stats['template_hits']}\n"
+            f"Answered by learned queries: {stats['learned_hits']}"
+            f" ({stats['learned_entries']} learned)\n"
+            f"Hit rate: {stats['hit_rate']:.0%}",
+        )
+
     def reset_cache(self):
         """Clear the command cache."""
-        self.cache.clear()
-        messagebox.showinfo("Cache Reset", "Command cache has been cleared.")
+        stats = self.cache.stats()
+        removed = self.cache.clear()
+        if self.intents:
+            self.intents.learn([])
+        messagebox.showinfo(
+            "Cache Reset",
+            f"Command cache has been cleared ({removed} entries).\n"
+            f"Hits: {stats['hits']} - Similar hits: {stats['similar_hits']}"
+            f" - Misses: {stats['misses']}",
+        )
 
     def navigate_history(self, event):
-        if self.command_history:
-            if event.keysym == "Up" and self.history_index > 0:
-                self.history_index -= 1
-            elif (
-                event.keysym == "Down"
-                and self.history_index < len(self.command_history) - 1
-            ):
-                self.history_index += 1
+        session = self.session
+        timeline = session.queries
+        if timeline:
+            if event.keysym == "Up" and session.history_index > 0:
+                session.history_index -= 1
+            elif event.keysym == "Down" and session.history_index < len(timeline) - 1:
+                session.history_index += 1
+            session.history_index = min(session.history_index, len(timeline) - 1)
             self.query_entry.delete(0, tk.END)
-            self.query_entry.insert(0, self.command_history[self.history_index])
+            self.query_entry.insert(0, timeline[session.history_index])
         return "break"
 
-    def run_terminal_command(self, command):
-        threading.Thread(target=self._execute_command, args=(command,)).start()
+    def run_terminal_command(self, command, session):
+        future = session.executor.submit(command)
+        future.add_done_callback(lambda f: self.report_command_error(f, session))
 
-    def _execute_command(self, command):
-        try:
-            self.terminal.run_command(command)
-        except PermissionError as e:
-            self.terminal.run_command("echo ''")
-            self.terminal.run_command("#\n")
-            self.terminal.run_command(f"# Permission denied: {e}")
-        except Exception as e:
-            self.terminal.run_command("echo ''")
-            self.terminal.run_command("#\n")
-            self.terminal.run_command(f"# [ERROR] Command failed: {e}")
+    def report_command_error(self, future, session):
+        if future.cancelled() or future.exception() is None:
+            return
+        e = future.exception()
+        if isinstance(e, PermissionError):
+            message = f"# Permission denied: {e}"
+        else:
+            message = f"# [ERROR] Command failed: {e}"
+        for line in ("echo ''", "#\n", message):
+            self.show_in_terminal(line, session)
 
-    def reset_cache(self):
-        messagebox.showinfo("Cache Reset", "Command cache cleared.")
+    def show_in_terminal(self, text, session=None):
+        # Queued behind running commands instead of blocking the Tk loop
+        (session or self.session).executor.submit(text, managed=False)
 
     def show_warning_and_edit(
         self,
         command,
+        session,
     ):
         warning_window = Toplevel(self)
         warning_window.title("Warning")
@@ -464,21 +3748,9 @@ class AIEnhancedTerminalApp(tk.Tk):
 
         def execute_command():
             modified_command = command_var.get().strip()
-            if whitelist_var.get():
-                whitelist_path = os.path.join(
-                    os.path.dirname(os.path.abspath(__file__)),
-                    "whitelisted_commands.txt",
-                )
-                try:
-                    with open(whitelist_path, "a") as file:
-                        file.write(modified_command.split()[0] + "\n")
-                except Exception as e:
-                    messagebox.showerror(
-                        "Error",
-                        f"Failed to add to whitelist: {e}",
-                        parent=warning_window,
-                    )
-            self.run_terminal_command(modified_command)
+            if whitelist_var.get() and modified_command:
+                self.store.add_command("whitelisted", modified_command.split()[0])
+            self.run_terminal_command(modified_command, session)
             warning_window.destroy()
 
         tk.Button(
@@ -498,6 +3770,9 @@ class AIEnhancedTerminalApp(tk.Tk):
         ).pack(side=tk.RIGHT, padx=10, pady=10)
 
     def show_help(self):
+        self.show_window("help", self.build_help_window)
+
+    def build_help_window(self):
         help_window = Toplevel(self)
         help_window.title("User Guide")
         help_window.geometry("800x500")
@@ -540,7 +3815,8 @@ class AIEnhancedTerminalApp(tk.Tk):
             "- During review, you can choose to add a command to whitelist.\n\n"
             "Advanced Features:\n"
             "- Command Cache:\n"
-            "   - Temporarily stores generated and used commands.\n"
+            "   - Stores generated commands on disk, so they survive restarts.\n"
+            "   - Old entries expire and the least recently used are evicted.\n"
             "   - Improves performance during continuous use.\n"
             "   - Use 'Reset Cache' to forget previous AI-generated commands.\n\n"
             "- Review System:\n"
@@ -570,13 +3846,241 @@ class AIEnhancedTerminalApp(tk.Tk):
         text_area.insert(tk.END, help_text)
         text_area.configure(state="disabled")
         text_area.pack(expand=True, fill="both", padx=10, pady=10)
+        return help_window
 
     def show_about(self):
         messagebox.showinfo(
             "About", "LAIB# Local AI Bash\nVersion 1.0\nDeveloped by gat"
         )
 
+    def on_close(self):
+        for session in self.sessions.values():
+            session.close()
+        self.scheduler.close()
+        self.llm_client.close()
+        self.cache.close()
+        if self.metrics_file:
+            try:
+                METRICS.export(self.metrics_file)
+            except OSError:
+                pass
+        self.destroy()
+
+
+def read_batch_queries(path):
+    """Read one query per line, or JSONL records with a query/prompt/title."""
+    queries = []
+    with open(path, "r") as file:
+        for number, line in enumerate(file, 1):
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError as e:
+                    show_error("Batch", f"{path}:{number}: skipped, invalid JSON: {e}")
+                    continue
+                query = record.get("query") or record.get("prompt") or record.get("title")
+                query_id = record.get("id", record.get("request_id", number))
+            else:
+                query, query_id = line, number
+            if isinstance(query, str) and query.strip():
+                queries.append((query_id, query.strip()))
+    return queries
+
+
+def run_batch(args):
+    global HEADLESS
+    HEADLESS = True
+
+    store = ConfigStore()
+    current_config = store.config()
+    tool_index = ToolIndex(TOOL_INDEX_FILE)
+    tool_index.refresh()
+    client = LLMClient(
+        current_config, HTTPLog(current_config.get("http_log_size", 500)), tool_index
+    )
+    policy = CommandPolicy(store)
+    cache = None
+    if not args.no_cache:
+        cache = CommandCache(
+            CACHE_FILE,
+            max_entries=current_config.get("cache_max_entries", 2000),
+            ttl=current_config.get("cache_ttl", 7 * 24 * 3600),
+            similarity_threshold=current_config.get("cache_similarity_threshold", 0.0),
+        )
+    generator = client
+    if current_config.get("candidates", 1) > 1:
+        generator = CandidateRanker(client, policy, cache, current_config["candidates"])
+    intents = None
+    if cache and current_config.get("fast_path", True):
+        intents = IntentMatcher()
+        intents.learn(
+            cache.frequent(
+                client.cache_namespace(),
+                current_config.get("fast_path_learned", 200),
+                current_config.get("fast_path_min_hits", 3),
+            )
+        )
+    scheduler = LLMScheduler(generator, args.workers)
+    cpu_seconds = current_config.get("command_cpu_limit", 30)
+    memory_mb = current_config.get("command_memory_limit_mb", 0)
+    # Translation is concurrent, executed commands run one at a time
+    run_lock = threading.Lock()
+    execute = args.execute and not args.dry_run
+
+    def translate(item):
+        query_id, query = item
+        start = time.perf_counter()
+        with METRICS.span("fast_path"):
+            ai_response = intents.match(query) if intents else None
+        fast_path = ai_response is not None
+        if not fast_path and cache:
+            ai_response = cache.get(client.cache_namespace(), query)
+        cached = ai_response is not None and not fast_path
+        if ai_response is None:
+            ai_response = scheduler.submit(query, PRIORITY_BATCH).result().strip()
+        elapsed = time.perf_counter() - start
+        METRICS.observe("query_total", elapsed)
+        result = {
+            "id": query_id,
+            "query": query,
+            "fast_path": fast_path,
+            "cached": cached,
+            "latency_ms": round(elapsed * 1000, 2),
+        }
+
+        command = strip_null_redirects(ai_response.split("\n")[0]).strip()
+        if not command and not ai_response.startswith("Error:"):
+            ai_response = "Error: the model returned an empty command."
+        if ai_response.startswith("Error:"):
+            result["error"] = ai_response
+            return result
+        if cache and not cached and not fast_path:
+            cache.put(client.cache_namespace(), query, ai_response)
+
+        verdict = policy.check(command)
+        result.update(command=command, verdict=verdict.action, rule=verdict.rule)
+        METRICS.incr(f"verdict_{verdict.action}")
+
+        # Commands needing review are never run without a human
+        if execute and command and verdict.action == "allow":
+            try:
+                with run_lock, METRICS.span("command_run"):
+                    exit_code, output = run_limited(
+                        command, args.timeout, cpu_seconds, memory_mb
+                    )
+                result["exit_code"] = exit_code
+                result["output_size"] = len(output)
+                result["output"] = output[-2000:]
+            except subprocess.TimeoutExpired:
+                METRICS.incr("command_timeouts")
+                result["exit_code"] = None
+                result["error"] = f"Error: command timed out after {args.timeout}s."
+        return result
+
+    queries = read_batch_queries(args.batch)
+    output = sys.stdout if args.output == "-" else open(args.output, "w")
+    verdicts = {}
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            for result in pool.map(translate, queries):
+                verdict = result.get("verdict", "error")
+                verdicts[verdict] = verdicts.get(verdict, 0) + 1
+                output.write(json.dumps(result) + "\n")
+                output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        scheduler.close()
+        client.close()
+        if cache:
+            cache.close()
+        metrics_file = args.metrics or current_config.get("metrics_file")
+        if metrics_file:
+            METRICS.export(metrics_file)
+
+    summary = ", ".join(f"{count} {verdict}" for verdict, count in verdicts.items())
+    if intents:
+        summary += f", fast path hit rate {intents.stats()['hit_rate']:.0%}"
+    print(
+        f"{len(queries)} queries in {time.perf_counter() - start:.2f}s ({summary})",
+        file=sys.stderr,
+    )
+    return 1 if "error" in verdicts else 0
+
+
+def profile_startup(app):
+    """Draw the first frame, finish startup and report where the time went."""
+    app.update_idletasks()
+    STARTUP.mark("draw first frame")
+    interactive = STARTUP.elapsed()
+    app.finish_startup()
+    STARTUP.mark("finish startup")
+    # The HTTP session is created in the background, wait for it
+    app.llm_client.connect()
+    STARTUP.mark("wait for http session")
+    app.on_close()
+
+    STARTUP.report()
+    print(f"time to interactive: {interactive * 1000:.1f} ms", file=sys.stderr)
+    return 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="LAIB# Local AI Bash")
+    parser.add_argument(
+        "--batch",
+        metavar="FILE",
+        help="translate the queries in FILE (text or JSONL) without the GUI",
+    )
+    parser.add_argument(
+        "--output", default="-", help="JSONL results file for --batch (default stdout)"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=4, help="concurrent requests in batch mode"
+    )
+    parser.add_argument(
+        "--execute",
+        action="store_true",
+        help="in batch mode, run the commands that need no review, one at a time",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only translate and check queries, never execute commands (default)",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="bypass the command cache"
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=30,
+        help="seconds before an executed batch command is killed",
+    )
+    parser.add_argument(
+        "--metrics",
+        metavar="FILE",
+        help="write stage timings and counters to FILE (.prom for Prometheus, else JSON)",
+    )
+    parser.add_argument(
+        "--profile-startup",
+        action="store_true",
+        help="start the GUI, report how long each startup phase took and exit",
+    )
+    return parser.parse_args(argv)
+
 
 if __name__ == "__main__":
+    STARTUP.mark("load laib.py")
+    args = parse_args()
+    if args.batch:
+        sys.exit(run_batch(args))
+
     app = AIEnhancedTerminalApp()
+    if args.profile_startup:
+        sys.exit(profile_startup(app))
     app.mainloop()
@@ -0,0 +1,69 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import laib
+
+
+class NormalizeQueryTest(unittest.TestCase):
+    def test_synonyms_fillers_and_determiners(self):
+        self.assertEqual(laib.normalize_query("Please show the files"), "list files")
+        self.assertEqual(laib.normalize_query("make a directory"), "create folder")
+
+    def test_names_keep_their_case(self):
+        self.assertEqual(laib.normalize_query("create folder Notes"), "create folder Notes")
+        self.assertEqual(laib.normalize_query("go to Music"), "go Music")
+
+    def test_quoted_words_are_kept(self):
+        self.assertEqual(laib.normalize_query('delete file "the"'), "delete file the")
+
+
+class IntentMatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.intents = laib.IntentMatcher()
+
+    def assertMatches(self, query, command):
+        self.assertEqual(self.intents.match(query), command)
+
+    def assertNoMatch(self, query):
+        self.assertIsNone(self.intents.match(query))
+
+    def test_folder_changes(self):
+        self.assertMatches("go to Music", "cd Music")
+        self.assertMatches("change directory to src", "cd src")
+        self.assertMatches("go ../build", "cd ../build")
+        self.assertMatches("cd src", "cd src")
+        self.assertMatches("go home", "cd ~")
+        self.assertMatches("go up", "cd ..")
+
+    def test_change_without_folder_cue(self):
+        self.assertNoMatch("change password")
+        self.assertNoMatch("change hostname")
+        self.assertNoMatch("go Music")
+
+    def test_vocabulary_arguments(self):
+        self.assertNoMatch("change user")
+        self.assertNoMatch("change the date")
+        self.assertNoMatch("change permissions")
+        self.assertNoMatch("go to users")
+        self.assertMatches('go to "users"', "cd users")
+
+    def test_typed_commands_are_not_rewritten(self):
+        self.assertNoMatch("ps")
+        self.assertNoMatch("df")
+        self.assertNoMatch("free")
+        self.assertMatches("ls", "ls")
+        self.assertMatches("show running processes", "ps aux")
+        self.assertMatches("free disk space", "df -h")
+
+    def test_unsafe_arguments(self):
+        self.assertNoMatch("create folder -rf")
+        self.assertNoMatch("delete file $(reboot)")
+        self.assertMatches("create folder notes", "mkdir notes")
+        self.assertMatches("delete file notes.txt", "rm notes.txt")
+
+    def test_learned_queries(self):
+        self.intents.learn({"list large files": "du -ah . | sort -rh | head"})
+        self.assertMatches("show the large files", "du -ah . | sort -rh | head")
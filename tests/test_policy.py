@@ -0,0 +1,124 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import laib
+
+
+class SplitShellCommandsTest(unittest.TestCase):
+    def assertRuns(self, command, expected):
+        self.assertIn(expected, laib.split_shell_commands(command))
+
+    def test_chains_and_substitutions(self):
+        self.assertEqual(
+            laib.split_shell_commands("ls | grep x && echo $(rm y)"),
+            [["ls"], ["grep", "x"], ["echo"], ["rm", "y"]],
+        )
+
+    def test_wrapper_options_and_arguments(self):
+        self.assertRuns("timeout 5 rm -rf x", ["rm", "-rf", "x"])
+        self.assertRuns("timeout -s KILL 5 rm x", ["rm", "x"])
+        self.assertRuns("watch -n 1 rm x", ["rm", "x"])
+        self.assertRuns("xargs -n 1 rm", ["rm"])
+        self.assertRuns("env FOO=1 rm x", ["rm", "x"])
+        self.assertRuns("nice -n 5 nohup rm x", ["rm", "x"])
+
+    def test_command_strings(self):
+        self.assertRuns("eval 'rm -rf ~'", ["rm", "-rf", "~"])
+        self.assertRuns("bash -c 'ls; rm x'", ["rm", "x"])
+        self.assertRuns("sh -o pipefail -c 'rm x'", ["rm", "x"])
+        self.assertRuns("env -S 'rm x'", ["rm", "x"])
+
+    def test_find_exec(self):
+        self.assertRuns("find . -exec rm -f {} +", ["rm", "-f", "{}"])
+        self.assertRuns("find . -execdir rm {} \\;", ["rm", "{}"])
+        self.assertRuns("find . -ok rm {} ';' -print", ["rm", "{}"])
+
+    def test_process_substitutions(self):
+        self.assertRuns("cat <(rm -rf x)", ["rm", "-rf", "x"])
+        self.assertRuns("cat <(rm -rf x)", ["cat"])
+        self.assertRuns("ls > >(rm x)", ["rm", "x"])
+        self.assertRuns("diff <(ls) <(shutdown now)", ["shutdown", "now"])
+        self.assertRuns("cat <(cat <(rm x)) file", ["cat", "file"])
+
+    def test_coproc(self):
+        self.assertRuns("coproc rm x", ["rm", "x"])
+
+    def test_unbalanced_quotes(self):
+        with self.assertRaises(ValueError):
+            laib.split_shell_commands("echo 'x")
+
+
+class CommandPolicyTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        paths = {}
+        for name, lines in (
+            ("blocked", ["# comment", "rm", "shutdown", "> /dev/sda"]),
+            ("whitelisted", ["cd", "ls", "git status"]),
+        ):
+            paths[name] = os.path.join(self.directory.name, f"{name}.txt")
+            with open(paths[name], "w") as file:
+                file.write("\n".join(lines) + "\n")
+        store = laib.ConfigStore(
+            os.path.join(self.directory.name, "config.json"),
+            paths["blocked"],
+            paths["whitelisted"],
+        )
+        self.policy = laib.CommandPolicy(store)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def action(self, command):
+        return self.policy.classify(command).action
+
+    def test_wrapped_blacklisted_commands_need_review(self):
+        for command in (
+            "timeout 5 rm -rf x",
+            "watch -n 1 rm x",
+            "xargs -n 1 rm",
+            "env FOO=1 rm x",
+            "eval 'rm -rf ~'",
+            "find . -exec rm -f {} +",
+            "find . -exec rm -f {} \\;",
+            "bash -c 'echo; rm x'",
+            "nohup shutdown now",
+            "xargs --unknown-option 3 rm",
+            "cat <(rm -rf x)",
+            "ls > >(rm x)",
+            "diff <(ls) <(shutdown now)",
+            "coproc rm x",
+            "coproc worker { rm x; }",
+        ):
+            with self.subTest(command=command):
+                self.assertEqual(self.action(command), "review")
+
+    def test_sudo_is_blocked_behind_wrappers(self):
+        self.assertEqual(self.action("sudo ls"), "block")
+        self.assertEqual(self.action("timeout 5 sudo ls"), "block")
+        self.assertEqual(self.action("bash -c 'sudo ls'"), "block")
+
+    def test_chains_need_every_command_allowed(self):
+        self.assertEqual(self.action("ls; rm -rf x"), "review")
+        self.assertEqual(self.action("cd /tmp && ls"), "allow")
+        self.assertEqual(self.action("git status"), "allow")
+
+    def test_plain_names_are_not_substrings(self):
+        self.assertEqual(self.action("echo abcd"), "allow")
+        self.assertEqual(self.action("find . -name '*.py'"), "allow")
+        self.assertEqual(self.action("timeout 5 ls"), "allow")
+
+    def test_literal_entries_and_parse_errors(self):
+        self.assertEqual(self.action("cat x > /dev/sda"), "review")
+        self.assertEqual(self.action("echo 'x"), "review")
+
+    def test_infinite_loops_are_blocked(self):
+        self.assertEqual(self.action("while true; do ls; done"), "block")
+
+
+if __name__ == "__main__":
+    unittest.main()